@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+PeerComps Benchmarks
+Times loading and comparables queries on synthetic datasets of increasing size
+and fails when a scenario regresses against the stored baseline
+
+Timings depend on the machine, so the baseline is not shipped: record one on
+the machine that runs the gate, then compare later runs against it.
+    python benchmark_peercomps.py --save-baseline
+    python benchmark_peercomps.py
+Without a baseline (and without --save-baseline) the run exits with status 2.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import peercomps
+from generate_synthetic_peercomps import generate_chunks, write_dataset
+
+
+# Dataset sizes run when none are given
+DEFAULT_SIZES = '10k,100k'
+
+# Allowed slowdown (or memory growth) before a scenario counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Latency differences below this are timer noise, not regressions
+MIN_REGRESSION_MS = 0.5
+
+# Memory differences below this are allocator noise, not regressions
+MIN_REGRESSION_MB = 1.0
+
+# Fewest timed query runs whose percentiles are stable enough to gate on
+MIN_GATE_REPEAT = 20
+
+
+def parse_size(text):
+    """Parse a row count such as 10000, 10k or 1M"""
+    text = text.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * scale)
+
+
+def dataset_path(data_dir, rows, seed):
+    """Synthetic dataset for this size and seed, generated on first use"""
+    extension = '.parquet' if importlib.util.find_spec('pyarrow') else '.csv'
+    
+    size_dir = os.path.join(data_dir, f"rows_{rows}")
+    os.makedirs(size_dir, exist_ok=True)
+    path = os.path.join(size_dir, f"peercomps_s{seed}{extension}")
+    if not os.path.exists(path):
+        print(f"Generating {rows:,} synthetic transactions...")
+        write_dataset(path, generate_chunks(rows, seed=seed, duplicate_rate=0.01))
+    return path
+
+
+def measure(func, repeat, warmup):
+    """
+    Time func and record its peak traced memory
+    
+    Latency runs are untraced; one extra run under tracemalloc gives the peak
+    memory, so tracing overhead never skews the timings.
+    
+    Returns:
+        Dict of p50/p95/p99 latency in ms, peak memory in MB and the run count
+    """
+    for _ in range(warmup):
+        func()
+    
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99])
+    return {
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'peak_mb': round(peak / 2**20, 2),
+        'runs': repeat
+    }
+
+
+def query_scenarios(store):
+    """
+    Comparables queries covering the engine's main paths
+    
+    Returns:
+        Dict of scenario name to find_comparables keyword arguments
+    """
+    codes = store.column('naics_code')
+    digits = store.column('naics_digits')
+    revenue = store.column('revenue')
+    median_revenue = float(np.nanmedian(revenue))
+    
+    # The most common full 6-digit code is an exact hit
+    six_digit = codes[digits == 6]
+    values, counts = np.unique(six_digit, return_counts=True)
+    exact = str(values[np.argmax(counts)])
+    
+    # A code whose 3-digit prefix is unused falls back to its 2-digit sector
+    fallback = None
+    for digit in '0123456789':
+        candidate = exact[:2] + digit + '999'
+        level_counts = store.naics_index.level_counts(candidate)
+        if level_counts[3] == 0 and level_counts[2] > 0:
+            fallback = candidate
+            break
+    
+    scenarios = {
+        'exact_6digit': dict(naics_code=exact, revenue=median_revenue, method='filter'),
+        # The revenue window is always 0.5x-2x; a sector prefix and no year cut-off make its bucket large
+        'broad_naics_all_years': dict(naics_code=exact[:2], revenue=median_revenue, year_range=100, method='filter'),
+        'large_max_results': dict(naics_code=exact[:3], revenue=median_revenue, max_results=5000, method='filter'),
+        'nearest': dict(naics_code=exact, revenue=median_revenue, sde=median_revenue * 0.18),
+        'nearest_large_max_results': dict(naics_code=exact, revenue=median_revenue, sde=median_revenue * 0.18,
+                                          max_results=1000)
+    }
+    if fallback is not None:
+        scenarios['fallback_2digit'] = dict(naics_code=fallback, revenue=median_revenue, method='filter')
+    return scenarios
+
+
+def run_size(rows, args):
+    """
+    Run every scenario on one dataset size
+    
+    Returns:
+        Dict of '<rows>/<scenario>' to its measurements
+    """
+    path = os.path.abspath(dataset_path(args.data_dir, rows, args.seed))
+    results = {}
+    
+    # The store cache lives next to each dataset
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    try:
+        print(f"\n{rows:,} rows")
+        
+        # Cold load: parse, deduplicate and index the file
+        results['load_cold'] = measure(lambda: peercomps.build_peercomps_store(path), args.load_repeat, 0)
+        
+        # Warm load: open the memory-mapped cache
+        store = peercomps.build_peercomps_store(path)
+        peercomps.write_peercomps_cache(store, path)
+        results['load_warm'] = measure(lambda: peercomps.open_peercomps_cache(path), args.load_repeat, 1)
+        
+        # Column resolution against the source header
+        columns = store.source_columns + [f"Extra Column {i}" for i in range(50)]
+        probe = pd.DataFrame(columns=columns, index=[0])
+        results['find_column'] = measure(
+            lambda: [peercomps.find_column(probe, terms) for terms in peercomps.PEERCOMPS_SCHEMA.values()],
+            args.repeat, args.warmup
+        )
+        
+        store = peercomps.open_peercomps_cache(path)
+        for name, kwargs in query_scenarios(store).items():
+            results[name] = measure(lambda: peercomps.find_comparables(store, **kwargs), args.repeat, args.warmup)
+    finally:
+        os.chdir(cwd)
+    
+    for name, result in results.items():
+        print(f"  {name:<28} p50 {result['p50_ms']:>10.2f} ms   p95 {result['p95_ms']:>10.2f} ms   "
+              f"p99 {result['p99_ms']:>10.2f} ms   peak {result['peak_mb']:>9.2f} MB")
+    return {f"{rows}/{name}": result for name, result in results.items()}
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare results with the baseline
+    
+    A scenario regresses when its p50 latency or peak memory exceeds the
+    baseline by more than the tolerance and by more than noise. The latency
+    noise floor is the baseline's own p50-p95 spread (at least
+    MIN_REGRESSION_MS), so a rerun of unchanged code does not trip the gate.
+    Scenarios missing from the baseline are skipped.
+    
+    Returns:
+        List of regression descriptions
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        slower = result['p50_ms'] - base['p50_ms']
+        noise_ms = max(MIN_REGRESSION_MS, base['p95_ms'] - base['p50_ms'])
+        if result['p50_ms'] > base['p50_ms'] * (1 + tolerance) and slower > noise_ms:
+            regressions.append(f"{key}: p50 {result['p50_ms']:.2f} ms vs baseline {base['p50_ms']:.2f} ms")
+        larger = result['peak_mb'] - base['peak_mb']
+        if result['peak_mb'] > base['peak_mb'] * (1 + tolerance) and larger > MIN_REGRESSION_MB:
+            regressions.append(f"{key}: peak {result['peak_mb']:.2f} MB vs baseline {base['peak_mb']:.2f} MB")
+    return regressions
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark PeerComps loading and comparables queries",
+        epilog="Run once with --save-baseline on this machine; later runs fail (exit 1) on a regression "
+               "and exit 2 when no baseline exists."
+    )
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Comma-separated row counts, e.g. 10k,100k,1M,10M")
+    parser.add_argument('--repeat', type=int, default=30,
+                        help=f"Timed runs per query scenario (at least {MIN_GATE_REPEAT})")
+    parser.add_argument('--warmup', type=int, default=3, help="Untimed runs before each query scenario")
+    parser.add_argument('--load-repeat', type=int, default=3, help="Timed runs per load scenario")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default='.benchmark_data', help="Where synthetic datasets are kept")
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed fractional slowdown or memory growth")
+    args = parser.parse_args()
+    args.data_dir = os.path.abspath(args.data_dir)
+    
+    # Fewer runs leave p50 and p95 too noisy to compare or to save as a baseline
+    if args.repeat < MIN_GATE_REPEAT:
+        parser.error(f"--repeat must be at least {MIN_GATE_REPEAT} for a stable comparison")
+    
+    # Fail before the (slow) runs rather than after them
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline on this machine to create one.")
+        sys.exit(2)
+    
+    results = {}
+    for rows in [parse_size(size) for size in args.sizes.split(',')]:
+        results.update(run_size(rows, args))
+    
+    print()
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"✓ Baseline written to {args.baseline}")
+        return
+    
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline, args.tolerance)
+    if regressions:
+        print("REGRESSIONS:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+    print(f"✓ No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -171,6 +171,16 @@ def generate_latex(data):
     mpsp = data.get('valuation', {}).get('mpsp', 0)
     naics = data.get('company', {}).get('naics_code', 'Unknown')
     usd_to_cad = data.get('valuation', {}).get('usd_to_cad_rate', None)
+    usd_to_cad_range = data.get('valuation', {}).get('usd_to_cad_range', None)
+    
+    # Comparables converted at year-specific rates report the range actually used
+    if usd_to_cad_range and usd_to_cad_range[0] != usd_to_cad_range[1]:
+        exchange_rate_text = (f"the exchange rate for each transaction's year, ranging from "
+                              f"{usd_to_cad_range[0]:.4f} to {usd_to_cad_range[1]:.4f}")
+    elif usd_to_cad_range:
+        exchange_rate_text = f"an exchange rate of {usd_to_cad_range[0]}"
+    else:
+        exchange_rate_text = f"an exchange rate of {usd_to_cad}"
     
     # Calculate scorecard ranges
     min_val = data.get('scorecard', {}).get('minimum_valuation', int(mpsp * 0.75))
@@ -372,12 +382,43 @@ Adj. EBITDA & ''' + str(data.get('valuation', {}).get('adj_ebitda_multiple', 0))
 \end{minipage}
 
 \vspace{0.5cm}
+'''
+    
+    # Add industry multiple percentiles if the export includes them
+    industry_multiples = data.get('valuation', {}).get('industry_multiples', {})
+    multiple_names = [('rev_mult', 'Revenue'), ('sde_mult', 'SDE'), ('ebitda_mult', 'Adj. EBITDA')]
+    industry_rows = [(field, name) for field, name in multiple_names if field in industry_multiples]
+    if industry_rows:
+        latex += r'''
+\noindent
+For context, the multiples paid across all PeerComps transactions in the same industry group were distributed as follows:
+
+\vspace{0.3cm}
+
+\begin{center}
+\small
+\begin{tabular}{|l|l|r|r|r|r|r|r|}
+\hline
+\rowcolor{tableheader}
+\textcolor{white}{\textbf{Multiple}} & \textcolor{white}{\textbf{NAICS / Revenue Band}} & \textcolor{white}{\textbf{Count}} & \textcolor{white}{\textbf{P10}} & \textcolor{white}{\textbf{P25}} & \textcolor{white}{\textbf{Median}} & \textcolor{white}{\textbf{P75}} & \textcolor{white}{\textbf{P90}} \\
+\hline
+'''
+        for i, (field, name) in enumerate(industry_rows):
+            stats = industry_multiples[field]
+            latex += r'''\rowcolor{''' + ('tableodd' if i % 2 == 0 else 'white') + r'''}
+''' + name + r''' & ''' + escape_latex(f"{stats.get('naics_prefix', '')} / {stats.get('revenue_band', '')}") + r''' & ''' + str(stats.get('count', 0)) + r''' & ''' + ' & '.join(f"{stats.get(q, 0):.2f}" for q in ['p10', 'p25', 'median', 'p75', 'p90']) + r''' \\
+\hline
+'''
+        latex += r'''\end{tabular}
+\end{center}
+
+\vspace{0.3cm}
 '''
     
     # Add currency conversion note if USD to CAD rate is provided
     if usd_to_cad:
         latex += r'''
-\textit{\small Note: Comparable transaction data sourced from U.S. market transactions. All amounts have been converted from USD to CAD at an exchange rate of ''' + str(usd_to_cad) + r'''. This conversion rate is an estimate and actual currency fluctuations may affect valuations.}
+\textit{\small Note: Comparable transaction data sourced from U.S. market transactions. All amounts have been converted from USD to CAD at ''' + exchange_rate_text + r'''. This conversion rate is an estimate and actual currency fluctuations may affect valuations.}
 
 \vspace{0.3cm}
 '''
@@ -1106,7 +1147,7 @@ When businesses have an existing marketing plan and established brand, obtaining
     # Add currency note if applicable
     if usd_to_cad:
         latex += r'''
-\textit{\small Note: All comparable transaction amounts have been converted from USD to CAD at an exchange rate of ''' + str(usd_to_cad) + r'''.}
+\textit{\small Note: All comparable transaction amounts have been converted from USD to CAD at ''' + exchange_rate_text + r'''.}
 
 \vspace{0.5cm}
 '''
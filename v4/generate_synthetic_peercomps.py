@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Synthetic PeerComps Generator
+Writes PeerComps-shaped datasets of any size for benchmarking and load testing,
+so performance work never needs the licensed PeerComps data
+"""
+
+import argparse
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import openpyxl
+
+
+# Column headers of the PeerComps export
+COLUMNS = ['NAICS Code', 'Year', 'Revenue', 'Sale Price', 'SDE', 'EBITDA', 'P/R', 'P/SDE', 'P/EBITDA']
+
+# NAICS sectors and their share of small-business transactions
+SECTOR_WEIGHTS = {
+    '11': 2, '21': 1, '22': 0.5, '23': 10, '31': 3, '32': 3, '33': 4, '42': 7,
+    '44': 9, '45': 5, '48': 4, '49': 1, '51': 3, '52': 3, '53': 3, '54': 12,
+    '55': 0.5, '56': 7, '61': 2, '62': 8, '71': 3, '72': 10, '81': 9, '92': 0.5
+}
+
+# Rows generated per chunk; output is streamed chunk by chunk
+CHUNK_ROWS = 250000
+
+# Excel's sheet limit, less the header row
+XLSX_MAX_ROWS = 1048575
+
+# Share of rows left blank in each optional field, like the real exports
+BLANK_RATES = {'Year': 0.02, 'SDE': 0.05, 'EBITDA': 0.10, 'P/R': 0.03, 'P/SDE': 0.03, 'P/EBITDA': 0.03}
+
+
+def build_naics_universe(rng, codes_per_sector=120):
+    """
+    Build a NAICS hierarchy of 6-digit codes with skewed popularity
+    
+    Each sector branches into subsectors, industry groups, industries and
+    national industries, so codes share prefixes at every level the engine
+    matches on.
+    
+    Returns:
+        Tuple of (6-digit code strings, selection probabilities,
+        per-code SDE multiple factor)
+    """
+    codes, weights, factors = [], [], []
+    
+    for sector, sector_weight in SECTOR_WEIGHTS.items():
+        # Digits 3-6 are drawn from a few values each so prefixes repeat
+        branches = rng.integers(1, 10, size=(codes_per_sector, 4))
+        branches[:, 1:] = np.minimum(branches[:, 1:], rng.integers(1, 4, size=(codes_per_sector, 3)))
+        sector_codes = np.unique([sector + ''.join(map(str, row)) for row in branches])
+        
+        # Zipf-like popularity within the sector
+        popularity = 1.0 / rng.permutation(np.arange(1, len(sector_codes) + 1))
+        codes.extend(sector_codes)
+        weights.extend(sector_weight * popularity / popularity.sum())
+        
+        # Industries sell at different multiples around a sector level
+        sector_factor = rng.normal(1.0, 0.12)
+        factors.extend(sector_factor * rng.normal(1.0, 0.06, size=len(sector_codes)))
+    
+    weights = np.asarray(weights)
+    return np.asarray(codes, dtype=object), weights / weights.sum(), np.clip(factors, 0.5, 1.6)
+
+
+def generate_chunk(rng, n_rows, codes, weights, factors, first_year, last_year):
+    """
+    Generate n_rows synthetic transactions with whole-array operations
+    
+    Returns:
+        DataFrame with the PeerComps column headers; blanks are NaN
+    """
+    picks = rng.choice(len(codes), size=n_rows, p=weights)
+    
+    # Recent years are better covered than old ones
+    years = np.arange(first_year, last_year + 1)
+    year_weights = np.linspace(1.0, 3.0, len(years))
+    year = rng.choice(years, size=n_rows, p=year_weights / year_weights.sum()).astype(float)
+    
+    # Revenue is log-normal around $800K
+    revenue = np.clip(np.round(rng.lognormal(np.log(800000), 1.0, size=n_rows)), 25000, 250000000)
+    
+    # SDE margin, with a few loss-making businesses
+    sde = np.round(revenue * np.clip(rng.normal(0.18, 0.08, size=n_rows), -0.15, 0.6))
+    ebitda = np.round(sde - revenue * np.clip(rng.normal(0.07, 0.03, size=n_rows), 0.0, 0.2))
+    
+    # Price from an SDE multiple with an industry factor and a size premium
+    sde_multiple = rng.lognormal(np.log(2.4), 0.3, size=n_rows) * factors[picks]
+    sde_multiple *= 1 + 0.12 * np.log10(revenue / 1000000).clip(-1, 2)
+    price = np.round(np.where(sde > 0, sde * sde_multiple, revenue * rng.uniform(0.1, 0.4, size=n_rows)))
+    
+    df = pd.DataFrame({
+        'NAICS Code': codes[picks],
+        'Year': year,
+        'Revenue': revenue,
+        'Sale Price': price,
+        'SDE': sde,
+        'EBITDA': ebitda,
+        'P/R': np.round(price / revenue, 2),
+        'P/SDE': np.where(sde > 0, np.round(price / np.where(sde > 0, sde, 1), 2), np.nan),
+        'P/EBITDA': np.where(ebitda > 0, np.round(price / np.where(ebitda > 0, ebitda, 1), 2), np.nan)
+    })
+    
+    for col, rate in BLANK_RATES.items():
+        df.loc[rng.random(n_rows) < rate, col] = np.nan
+    for col in ['Year', 'Revenue', 'Sale Price', 'SDE', 'EBITDA']:
+        df[col] = df[col].astype('Int64')
+    return df
+
+
+def generate_chunks(n_rows, seed=0, first_year=2005, last_year=None, duplicate_rate=0.0):
+    """
+    Yield the synthetic dataset CHUNK_ROWS rows at a time
+    
+    The same seed and arguments always produce the same rows.
+    
+    Args:
+        n_rows: Total rows to generate
+        seed: Random seed
+        first_year: Earliest transaction year
+        last_year: Latest transaction year (default: last year)
+        duplicate_rate: Share of rows that repeat an earlier row of the same
+            chunk, to exercise deduplication
+    """
+    last_year = last_year or datetime.now().year - 1
+    seeds = np.random.SeedSequence(seed)
+    codes, weights, factors = build_naics_universe(np.random.default_rng(seeds.spawn(1)[0]))
+    
+    n_chunks = -(-n_rows // CHUNK_ROWS)
+    for i, chunk_seed in enumerate(seeds.spawn(n_chunks)):
+        rng = np.random.default_rng(chunk_seed)
+        size = min(CHUNK_ROWS, n_rows - i * CHUNK_ROWS)
+        df = generate_chunk(rng, size, codes, weights, factors, first_year, last_year)
+        
+        if duplicate_rate > 0 and size > 1:
+            repeat = np.flatnonzero(rng.random(size) < duplicate_rate)
+            repeat = repeat[repeat > 0]
+            df.iloc[repeat] = df.iloc[rng.integers(0, repeat)].to_numpy()
+        yield df
+
+
+def write_dataset(path, chunks):
+    """
+    Stream chunks to .xlsx, .csv or .parquet, chosen by the file extension
+    
+    Returns:
+        Number of rows written
+    """
+    extension = os.path.splitext(path)[1].lower()
+    rows = 0
+    
+    if extension == '.csv':
+        for i, df in enumerate(chunks):
+            df.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            rows += len(df)
+    
+    elif extension == '.parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for df in chunks:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                rows += len(df)
+        finally:
+            if writer is not None:
+                writer.close()
+    
+    elif extension == '.xlsx':
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet('PeerComps')
+        sheet.append(COLUMNS)
+        for df in chunks:
+            # Blanks become empty cells
+            values = df.astype(object).where(df.notna(), None)
+            for row in values.itertuples(index=False, name=None):
+                sheet.append(row)
+            rows += len(df)
+        workbook.save(path)
+    
+    else:
+        raise ValueError(f"Unsupported output format '{extension}' (use .xlsx, .csv or .parquet)")
+    
+    return rows
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Generate a synthetic PeerComps dataset")
+    parser.add_argument('rows', type=int, help="Number of transactions, e.g. 10000 or 10000000")
+    parser.add_argument('output', help="Output file (.xlsx, .csv or .parquet)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--first-year', type=int, default=2005)
+    parser.add_argument('--last-year', type=int, default=None, help="Latest transaction year (default: last year)")
+    parser.add_argument('--duplicates', type=float, default=0.0, help="Share of repeated rows, e.g. 0.01")
+    args = parser.parse_args()
+    
+    if args.output.lower().endswith('.xlsx') and args.rows > XLSX_MAX_ROWS:
+        print(f"ERROR: An .xlsx sheet holds at most {XLSX_MAX_ROWS:,} rows; use .csv or .parquet.")
+        sys.exit(1)
+    
+    chunks = generate_chunks(args.rows, args.seed, args.first_year, args.last_year, args.duplicates)
+    try:
+        rows = write_dataset(args.output, chunks)
+    except ImportError:
+        print("ERROR: Writing .parquet needs pyarrow (pip install pyarrow).")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    
+    print(f"✓ Wrote {rows:,} synthetic transactions to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
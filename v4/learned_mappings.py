@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Learned Financial Data Mappings
+Remembers the column mappings analysts accept for uploaded financial data, so a
+repeat export from the same accounting system is mapped without fuzzy matching
+"""
+
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Local SQLite file holding accepted mappings
+LEARNED_MAPPINGS_PATH = 'learned_mappings.sqlite'
+
+# Labels looked up per query, below SQLite's bound parameter limit
+LOOKUP_BATCH = 500
+
+def normalize_label(label):
+    """Label as compared between uploads: trimmed, case-folded, single-spaced"""
+    return ' '.join(str(label).split()).casefold()
+
+def label_set_fingerprint(labels):
+    """SHA-256 of an upload's set of row or column labels (order and case do not matter)"""
+    normalized = sorted({normalize_label(label) for label in labels})
+    return hashlib.sha256('\n'.join(normalized).encode()).hexdigest()
+
+class LearnedMappings:
+    """
+    SQLite store of accepted mappings from upload labels to required items
+    
+    Two tables are kept. label_sets holds the complete mapping accepted for
+    each label-set fingerprint, including items left unmapped, so an upload
+    with the same labels is mapped by one exact lookup. label_mappings counts
+    how often each normalized label was accepted for a required item, so a
+    label seen before maps straight away even when the rest of the upload is new.
+    """
+    
+    def __init__(self, path=LEARNED_MAPPINGS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS label_sets (
+                    fingerprint TEXT NOT NULL,
+                    required_item TEXT NOT NULL,
+                    source_label TEXT,
+                    PRIMARY KEY (fingerprint, required_item)
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS label_mappings (
+                    source_label TEXT NOT NULL,
+                    required_item TEXT NOT NULL,
+                    accepted INTEGER NOT NULL,
+                    PRIMARY KEY (source_label, required_item)
+                )
+            """)
+    
+    @contextmanager
+    def _transaction(self):
+        """Connection for one transaction, committed on success and always closed"""
+        with self._lock:
+            db = sqlite3.connect(self.path, timeout=10)
+            try:
+                with db:
+                    yield db
+            finally:
+                db.close()
+    
+    def lookup_label_set(self, labels):
+        """
+        Mapping accepted for an upload with exactly these labels
+        
+        Returns:
+            Dict of required item to the label it was mapped to (None if it was
+            left unmapped), or {} if this label set has not been seen
+        """
+        with self._transaction() as db:
+            rows = db.execute(
+                "SELECT required_item, source_label FROM label_sets WHERE fingerprint = ?",
+                (label_set_fingerprint(labels),)
+            ).fetchall()
+        
+        # Map the stored labels back to this upload's spelling
+        by_normalized = {}
+        for label in labels:
+            by_normalized.setdefault(normalize_label(label), label)
+        return {
+            item: None if source is None else by_normalized.get(normalize_label(source))
+            for item, source in rows
+        }
+    
+    def lookup_labels(self, labels):
+        """
+        Required item each previously accepted label maps to
+        
+        Returns:
+            Dict of label (as spelled in labels) to its most often accepted
+            required item; labels never accepted are left out
+        """
+        by_normalized = {}
+        for label in labels:
+            by_normalized.setdefault(normalize_label(label), label)
+        
+        normalized = list(by_normalized)
+        rows = []
+        with self._transaction() as db:
+            for start in range(0, len(normalized), LOOKUP_BATCH):
+                batch = normalized[start:start + LOOKUP_BATCH]
+                rows += db.execute(
+                    f"SELECT source_label, required_item, accepted FROM label_mappings "
+                    f"WHERE source_label IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+        
+        learned = {}
+        for source, item, _ in sorted(rows, key=lambda row: -row[2]):
+            learned.setdefault(by_normalized[source], item)
+        return learned
+    
+    def save(self, labels, mapping):
+        """
+        Record the mapping an analyst accepted for an upload
+        
+        Args:
+            labels: All row or column labels of the upload
+            mapping: Dict of required item to the chosen label, or None
+        """
+        fingerprint = label_set_fingerprint(labels)
+        with self._transaction() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO label_sets (fingerprint, required_item, source_label) VALUES (?, ?, ?)",
+                [(fingerprint, item, None if label is None else str(label)) for item, label in mapping.items()]
+            )
+            db.executemany(
+                "INSERT INTO label_mappings (source_label, required_item, accepted) VALUES (?, ?, 1) "
+                "ON CONFLICT (source_label, required_item) DO UPDATE SET accepted = accepted + 1",
+                [(normalize_label(label), item) for item, label in mapping.items() if label is not None]
+            )
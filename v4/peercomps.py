@@ -0,0 +1,2171 @@
+#!/usr/bin/env python3
+"""
+PeerComps Comparables Engine
+Loads, indexes and searches the PeerComps transaction dataset without Streamlit,
+so the valuation app, scripts and batch jobs share one implementation
+"""
+
+import pandas as pd
+import numpy as np
+import json
+from datetime import datetime
+import openpyxl
+import os
+import sys
+import hashlib
+import threading
+import shutil
+from collections import OrderedDict
+
+# KD-trees for nearest-neighbour comparables; without scipy a brute-force scan is used
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# PeerComps dataset location and on-disk columnar cache
+PEERCOMPS_PATH = 'PeerComps_dataset.xlsx'
+PEERCOMPS_CACHE_DIR = '.peercomps_cache'
+PEERCOMPS_CACHE_META = os.path.join(PEERCOMPS_CACHE_DIR, 'meta.json')
+# Bump when the cached store's layout changes so old caches are rebuilt
+PEERCOMPS_CACHE_FORMAT = 9
+
+# Rows parsed per batch when streaming the workbook
+PEERCOMPS_BATCH_ROWS = 50000
+
+# Delta workbooks ingested on top of the main workbook, replayed on every full rebuild
+PEERCOMPS_DELTA_DIR = 'PeerComps_deltas'
+PEERCOMPS_DELTA_MANIFEST = os.path.join(PEERCOMPS_DELTA_DIR, 'manifest.json')
+
+# Local USD to CAD rate table: CSV with 'year', 'rate' and optionally 'month' columns
+FX_RATES_PATH = 'usd_cad_rates.csv'
+
+# Fields that identify a transaction when deduplicating deliveries
+FINGERPRINT_FIELDS = ['naics_code', 'year', 'revenue', 'price', 'sde', 'ebitda']
+
+# Canonical PeerComps fields and the source column names they may appear under
+PEERCOMPS_SCHEMA = {
+    'naics': ['NAICS Code', 'NAICS', 'naics_code', 'Industry Code'],
+    'year': ['Year', 'year', 'Transaction Year', 'Sale Year'],
+    'revenue': ['Revenue', 'revenue', 'Sales', 'Annual Revenue'],
+    'price': ['Sale Price', 'Price', 'price', 'Transaction Price', 'Purchase Price'],
+    'sde': ['SDE', 'sde', 'Seller Discretionary Earnings'],
+    'ebitda': ['EBITDA', 'ebitda', 'Adj EBITDA', 'Adjusted EBITDA'],
+    'rev_mult': ['P/R', 'p/r', 'Revenue Multiple', 'Price/Revenue'],
+    'sde_mult': ['P/SDE', 'p/sde', 'SDE Multiple', 'Price/SDE'],
+    'ebitda_mult': ['P/EBITDA', 'p/ebitda', 'EBITDA Multiple', 'Price/EBITDA']
+}
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Compute the SHA-256 of a file without reading it into memory at once"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def open_peercomps_cache(source_path):
+    """
+    Open the memory-mapped PeerComps store if it was built from the current source file
+    
+    The cache is keyed on the workbook's size, mtime and content hash, and on the
+    delta manifest: a cache missing an ingested delta (or holding one the
+    manifest does not list) is rebuilt. Size and mtime are checked first; the
+    file is only hashed when the mtime changed, so a workbook that was touched
+    but not edited keeps its cache.
+    
+    Returns:
+        PeerCompsStore if the cache is valid, None otherwise
+    """
+    if not os.path.exists(PEERCOMPS_CACHE_META):
+        return None
+    
+    try:
+        with open(PEERCOMPS_CACHE_META) as f:
+            meta = json.load(f)
+        
+        if meta.get('format') != PEERCOMPS_CACHE_FORMAT:
+            return None
+        
+        deltas = read_delta_hashes()
+        if meta.get('deltas') != deltas:
+            return None
+        
+        stat = os.stat(source_path)
+        if meta.get('size') != stat.st_size:
+            return None
+        
+        if meta.get('mtime_ns') != stat.st_mtime_ns:
+            if meta.get('sha256') != file_sha256(source_path):
+                return None
+            # Same content, new mtime - remember it so the next load skips hashing
+            meta['mtime_ns'] = stat.st_mtime_ns
+            _write_json_atomic(PEERCOMPS_CACHE_META, meta)
+        
+        store = PeerCompsStore.open(os.path.join(PEERCOMPS_CACHE_DIR, meta['version']))
+        return store if store.deltas == deltas else None
+    except Exception as e:
+        print(f"Ignoring PeerComps cache: {e}")
+        return None
+
+def write_peercomps_cache(store, source_path):
+    """
+    Save the store to the cache directory, keyed on the source file
+    
+    Each dataset version gets its own directory, written under a temporary name
+    and renamed into place, so a worker never maps a half-written store. When
+    several workers build the same version at once the first rename wins.
+    
+    A store whose deltas differ from the manifest is not written: it was built
+    before a delta was ingested, and writing it would replace the cache that
+    holds the delta.
+    
+    Returns:
+        True if the cache now holds this version
+    """
+    try:
+        if store.deltas != read_delta_hashes():
+            print("Not caching PeerComps store: the delta manifest changed while it was built")
+            return False
+        
+        os.makedirs(PEERCOMPS_CACHE_DIR, exist_ok=True)
+        stat = os.stat(source_path)
+        store_dir = os.path.join(PEERCOMPS_CACHE_DIR, store.version)
+        
+        if not os.path.exists(store_dir):
+            tmp_dir = f"{store_dir}.{os.getpid()}.tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            store.save(tmp_dir)
+            try:
+                os.rename(tmp_dir, store_dir)
+            except OSError:
+                # Another worker finished first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        
+        meta = {
+            'format': PEERCOMPS_CACHE_FORMAT,
+            'source': os.path.abspath(source_path),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': store.source_sha256,
+            'version': store.version,
+            'deltas': store.deltas
+        }
+        _write_json_atomic(PEERCOMPS_CACHE_META, meta)
+        
+        # Drop older versions; workers still mapping them keep their open files
+        for name in os.listdir(PEERCOMPS_CACHE_DIR):
+            path = os.path.join(PEERCOMPS_CACHE_DIR, name)
+            if os.path.isdir(path) and name != store.version and not name.endswith('.tmp'):
+                shutil.rmtree(path, ignore_errors=True)
+        return True
+    except Exception as e:
+        # Caching is best-effort; the app works the same without it
+        print(f"Could not write PeerComps cache: {e}")
+        return False
+
+def _write_json_atomic(path, data):
+    """Write JSON to a temp file and move it into place"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def read_peercomps_batches(path, batch_rows=PEERCOMPS_BATCH_ROWS, progress=None):
+    """
+    Stream a PeerComps workbook (.xlsx) or export (.csv, .parquet) as cleaned batches
+    
+    Rows are read with openpyxl in read-only mode (or pandas' chunked CSV
+    reader, or pyarrow's Parquet batches) and handed on batch_rows at a time,
+    so parsing memory stays bounded however large the file is.
+    
+    Args:
+        path: Workbook, CSV or Parquet file
+        batch_rows: Maximum rows per batch
+        progress: Optional callback(rows_read, total_rows); total_rows is None when unknown
+    
+    Yields:
+        DataFrames with the source column names; empty rows and a repeated
+        header row at the top of the data are removed
+    """
+    if path.lower().endswith('.csv'):
+        batches, total_rows = pd.read_csv(path, chunksize=batch_rows), None
+    elif path.lower().endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(path)
+        total_rows = parquet.metadata.num_rows
+        batches = (batch.to_pandas() for batch in parquet.iter_batches(batch_size=batch_rows))
+    else:
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        sheet = workbook.active
+        total_rows = sheet.max_row - 1 if sheet.max_row else None
+        batches = _sheet_batches(workbook, sheet, batch_rows)
+    
+    rows_read = 0
+    checked_header = False
+    for batch in batches:
+        rows_read += len(batch)
+        # Clean column names - strip whitespace and standardize
+        batch.columns = dedupe_column_names(batch.columns.astype(str).str.strip())
+        
+        # Remove any completely empty rows
+        batch = batch.dropna(how='all')
+        
+        # Remove header rows that might be in the data
+        # (sometimes Excel files have multiple header rows)
+        if not checked_header and len(batch) > 0:
+            checked_header = True
+            first_row = batch.iloc[0]
+            if any(str(val).lower() in ['naics', 'revenue', 'price', 'year'] for val in first_row):
+                batch = batch.iloc[1:]
+        
+        if progress:
+            progress(rows_read, total_rows)
+        yield batch
+
+def dedupe_column_names(names):
+    """
+    Make repeated column names unique the way pandas' readers do
+    
+    A repeat of 'Revenue' becomes 'Revenue.1', then 'Revenue.2', ..., skipping
+    suffixes already taken by another column.
+    """
+    names = list(names)
+    counts = {}
+    for i, name in enumerate(names):
+        base = name
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[base] = count + 1
+            name = f"{base}.{count}"
+            count = count + 1 if name in names else counts.get(name, 0)
+        names[i] = name
+        counts[name] = count + 1
+    return names
+
+def _sheet_batches(workbook, sheet, batch_rows):
+    """Yield DataFrames of batch_rows rows from a read-only openpyxl sheet"""
+    try:
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = dedupe_column_names([f"Unnamed: {i}" if name is None else str(name) for i, name in enumerate(header)])
+        
+        batch = []
+        for row in rows:
+            batch.append(row[:len(columns)])
+            if len(batch) >= batch_rows:
+                yield pd.DataFrame.from_records(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame.from_records(batch, columns=columns)
+    finally:
+        workbook.close()
+
+def resolve_peercomps_schema(columns):
+    """Map each canonical PeerComps field to the source column it was found under (or None)"""
+    # find_column only looks at the names, but skips empty frames
+    probe = pd.DataFrame(columns=columns, index=[0])
+    return {field: find_column(probe, search_terms) for field, search_terms in PEERCOMPS_SCHEMA.items()}
+
+def read_canonical_peercomps(path, progress=None):
+    """
+    Stream a PeerComps file straight into the typed canonical columns
+    
+    Each batch is converted to canonical form as soon as it is read and only
+    the typed arrays are kept, so the raw rows never accumulate in memory.
+    
+    Returns:
+        Tuple of (canonical frame, source column names, schema)
+    """
+    source_columns, schema = [], None
+    parts = {}
+    
+    for batch in read_peercomps_batches(path, progress=progress):
+        if schema is None:
+            source_columns = batch.columns.tolist()
+            schema = resolve_peercomps_schema(source_columns)
+        for name, values in to_canonical_peercomps(batch, schema).items():
+            parts.setdefault(name, []).append(values.to_numpy())
+    
+    if schema is None:
+        schema = {field: None for field in PEERCOMPS_SCHEMA}
+    
+    # Concatenate one column at a time, releasing its batches as we go
+    columns = {name: np.concatenate(parts.pop(name)) for name in list(parts)}
+    return pd.DataFrame(columns, copy=False), source_columns, schema
+
+def to_canonical_peercomps(df, schema):
+    """
+    Build the typed canonical PeerComps frame
+    
+    Each resolved field becomes one column named after the field; fields with no
+    source column are left out. NAICS is kept as its text label alongside the
+    normalized integer code, and every other field is coerced to float.
+    """
+    canonical = pd.DataFrame(index=pd.RangeIndex(len(df)))
+    
+    for field, col in schema.items():
+        if col is None:
+            continue
+        if field == 'naics':
+            canonical['naics'] = naics_labels(df[col])
+            canonical['naics_code'], canonical['naics_digits'] = normalize_naics(canonical['naics'])
+        else:
+            canonical[field] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float)
+    
+    canonical['fingerprint'] = transaction_fingerprints(canonical)
+    return canonical
+
+def naics_labels(values):
+    """
+    Text labels for NAICS values
+    
+    Whole numbers are written without a decimal part, whether the reader
+    produced an int or a float (a column with blanks reads as float), and
+    blanks become empty strings.
+    """
+    values = pd.Series(values, dtype=object).reset_index(drop=True)
+    numeric = pd.to_numeric(values, errors='coerce')
+    whole = numeric.notna() & (numeric == np.floor(numeric))
+    
+    labels = values.astype(str).str.strip()
+    labels[whole] = numeric[whole].astype(np.int64).astype(str)
+    labels[values.isna()] = ''
+    return labels.to_numpy(dtype=object)
+
+def transaction_fingerprints(df):
+    """
+    64-bit fingerprint of each transaction
+    
+    Hashes the normalized (NAICS, year, revenue, price, SDE, EBITDA) tuple, with
+    amounts rounded to whole dollars, so the same deal delivered twice gets the
+    same fingerprint. Fields missing from the frame hash as blank.
+    """
+    key = pd.DataFrame({
+        field: np.round(np.asarray(df[field], dtype=float)) if field in df.columns else np.full(len(df), np.nan)
+        for field in FINGERPRINT_FIELDS
+    })
+    return pd.util.hash_pandas_object(key, index=False).to_numpy()
+
+def drop_duplicate_transactions(df):
+    """
+    Drop repeated transactions from a canonical frame in one vectorized pass
+    
+    Rows are compared by fingerprint through a hash table; the first row with
+    each fingerprint is kept.
+    
+    Returns:
+        Tuple of (frame without the repeats, number of rows removed)
+    """
+    repeated = pd.Series(df['fingerprint'].to_numpy()).duplicated().to_numpy()
+    if not repeated.any():
+        return df, 0
+    attrs = df.attrs
+    df = df[~repeated].reset_index(drop=True)
+    df.attrs = attrs
+    return df, int(repeated.sum())
+
+def build_peercomps_frame(path, progress=None):
+    """
+    Parse the workbook into the canonical PeerComps frame
+    
+    Transactions the workbook repeats are dropped. The returned frame carries
+    its provenance in df.attrs: 'version' (the workbook's content hash),
+    'source_columns', the resolved 'schema' and 'duplicates_removed'.
+    """
+    df, source_columns, schema = read_canonical_peercomps(path, progress)
+    df, duplicates = drop_duplicate_transactions(df)
+    if duplicates:
+        print(f"PeerComps: removed {duplicates:,} duplicate transactions")
+    df.attrs = {
+        # The workbook's content hash identifies this version of the dataset
+        'version': file_sha256(path),
+        'source_columns': source_columns,
+        'schema': schema,
+        'duplicates_removed': duplicates
+    }
+    return df
+
+def build_delta_frame(path):
+    """Parse a delta workbook into a canonical frame, resolving its own column names"""
+    return read_canonical_peercomps(path)[0]
+
+def read_delta_manifest():
+    """File names of ingested delta workbooks, in the order they were applied"""
+    if not os.path.exists(PEERCOMPS_DELTA_MANIFEST):
+        return []
+    with open(PEERCOMPS_DELTA_MANIFEST) as f:
+        return json.load(f)
+
+def read_delta_hashes():
+    """Content hashes of the ingested delta workbooks, in the order they were applied"""
+    return [os.path.splitext(name)[0] for name in read_delta_manifest()]
+
+def read_cache_version():
+    """Dataset version the cache metadata points at, or None"""
+    try:
+        with open(PEERCOMPS_CACHE_META) as f:
+            return json.load(f).get('version')
+    except (OSError, ValueError):
+        return None
+
+def build_peercomps_store(path, progress=None):
+    """Build the store from the main workbook and replay every ingested delta"""
+    store = PeerCompsStore.from_frame(build_peercomps_frame(path, progress))
+    for name in read_delta_manifest():
+        delta_path = os.path.join(PEERCOMPS_DELTA_DIR, name)
+        store, _, _ = store.append(build_delta_frame(delta_path), file_sha256(delta_path))
+    return store
+
+def ingest_peercomps_delta(delta_path, source_path=PEERCOMPS_PATH):
+    """
+    Append a delta workbook of new transactions to the PeerComps store
+    
+    Rows whose transaction fingerprint is already in the store (or repeated
+    within the delta) are skipped. The NAICS/revenue index is merged rather than
+    rebuilt, the dataset version is bumped, and the new version is written to
+    the cache so every worker picks it up on its next rerun. A copy of the
+    delta is kept in PEERCOMPS_DELTA_DIR and replayed if the main workbook is
+    ever re-parsed.
+    
+    Returns:
+        Dict with 'added', 'duplicates', 'version' and 'already_ingested'
+    
+    Raises:
+        ValueError: If the delta has no NAICS column or no transactions; nothing
+            is ingested or recorded in the manifest
+        RuntimeError: If the new version could not be written to the cache; the
+            manifest is restored, so the delta is not ingested
+    """
+    delta_sha = file_sha256(delta_path)
+    delta_df, _, schema = read_canonical_peercomps(delta_path)
+    if schema['naics'] is None:
+        raise ValueError(
+            f"No NAICS column in {os.path.basename(delta_path)} "
+            f"(expected one of: {', '.join(PEERCOMPS_SCHEMA['naics'])})"
+        )
+    if len(delta_df) == 0:
+        raise ValueError(f"No transactions in {os.path.basename(delta_path)}")
+    
+    store = open_peercomps_cache(source_path)
+    if store is None:
+        store = build_peercomps_store(source_path)
+    
+    if delta_sha in store.deltas:
+        return {'added': 0, 'duplicates': 0, 'version': store.version, 'already_ingested': True}
+    
+    new_store, added, duplicates = store.append(delta_df, delta_sha)
+    
+    # Keep the delta so a rebuild from the main workbook can replay it
+    os.makedirs(PEERCOMPS_DELTA_DIR, exist_ok=True)
+    name = delta_sha + os.path.splitext(delta_path)[1]
+    copy_path = os.path.join(PEERCOMPS_DELTA_DIR, name)
+    shutil.copyfile(delta_path, copy_path)
+    manifest = read_delta_manifest()
+    _write_json_atomic(PEERCOMPS_DELTA_MANIFEST, [entry for entry in manifest if entry != name] + [name])
+    
+    if not write_peercomps_cache(new_store, source_path):
+        _write_json_atomic(PEERCOMPS_DELTA_MANIFEST, manifest)
+        if name not in manifest:
+            os.remove(copy_path)
+        raise RuntimeError("Could not write the PeerComps cache; the delta was not ingested")
+    return {'added': added, 'duplicates': duplicates, 'version': new_store.version, 'already_ingested': False}
+
+def peercomps_state():
+    """Cheap signature of the workbook, cache metadata and delta manifest; changes when any is replaced"""
+    signature = []
+    for path in (PEERCOMPS_PATH, PEERCOMPS_CACHE_META, PEERCOMPS_DELTA_MANIFEST):
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+class PeerCompsLoader:
+    """
+    Loads the PeerComps store in a background thread
+    
+    ensure_started() begins a load and returns at once; the valuation app calls
+    it on its first run, so the workbook is parsed and indexed while the first
+    user fills in the other tabs. Progress is kept on the loader for a UI to
+    poll.
+    
+    When the workbook or the cache changes (peercomps_state()) a new load starts.
+    status is 'idle', 'loading', 'ready', 'missing' (no workbook) or 'failed'.
+    """
+    
+    def __init__(self):
+        self.state = None
+        self.store = None
+        self.status = 'idle'
+        self.error = None
+        self.rows_read = 0
+        self.total_rows = None
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def ensure_started(self):
+        """Start a load unless one for the current workbook and cache already ran or is running"""
+        state = peercomps_state()
+        with self._lock:
+            if state == self.state:
+                return
+            self.state = state
+            self.status = 'loading'
+            self.error = None
+            self.rows_read, self.total_rows = 0, None
+            self._thread = threading.Thread(target=self._run, args=(state,), name="peercomps-loader", daemon=True)
+            self._thread.start()
+    
+    def wait(self, timeout=None):
+        """Block until the current load finishes"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+    
+    @property
+    def progress(self):
+        """Fraction of the workbook read so far, or None if the size is unknown"""
+        if not self.total_rows:
+            return None
+        return min(self.rows_read / self.total_rows, 1.0)
+    
+    def _report_progress(self, rows_read, total_rows):
+        self.rows_read, self.total_rows = rows_read, total_rows
+        print(f"PeerComps load: {rows_read:,} rows read")
+    
+    def _run(self, state):
+        store, status, error = None, 'ready', None
+        try:
+            store = read_peercomps_store(self._report_progress)
+            if store is None:
+                status = 'missing'
+            else:
+                # Print column names for debugging
+                print(f"PeerComps columns: {store.source_columns}")
+                print(f"PeerComps shape: ({len(store)}, {len(store.columns)})")
+        except Exception as e:
+            status, error = 'failed', str(e)
+            import traceback
+            print(traceback.format_exc())
+        
+        with self._lock:
+            if self.state != state:
+                # A newer load has started; its result wins
+                return
+            self.store, self.status, self.error = store, status, error
+            # Writing the cache changes its part of the signature. Adopt the new
+            # signature only if the cache now holds this store; otherwise (a delta
+            # was ingested meanwhile) the next ensure_started() loads again.
+            current = peercomps_state()
+            if current[0] == state[0] and store is not None and read_cache_version() == store.version:
+                self.state = current
+
+def read_peercomps_store(progress=None):
+    """
+    Open the PeerComps store, building and caching it if needed
+    
+    The store is memory-mapped from the cache directory, so every worker
+    process on the machine shares the same read-only pages, and a worker that
+    finds a current cache starts without parsing or indexing anything.
+    
+    Returns:
+        PeerCompsStore, or None if the workbook does not exist
+    """
+    if not os.path.exists(PEERCOMPS_PATH):
+        return None
+    
+    store = open_peercomps_cache(PEERCOMPS_PATH)
+    if store is None:
+        store = build_peercomps_store(PEERCOMPS_PATH, progress)
+        if write_peercomps_cache(store, PEERCOMPS_PATH):
+            # Serve from the mapped copy like every other worker
+            store = open_peercomps_cache(PEERCOMPS_PATH) or store
+    
+    return store
+
+def find_column(df, search_terms, exact_first=True):
+    """
+    Robustly find a column in the dataframe
+    
+    Args:
+        df: DataFrame to search
+        search_terms: List of terms to search for (in order of preference)
+        exact_first: If True, try exact matches first
+    
+    Returns:
+        Column name if found, None otherwise
+    """
+    if df is None or df.empty:
+        return None
+    
+    # Normalize column names
+    cols_lower = {col: col.lower().strip() for col in df.columns}
+    
+    # Try exact matches first
+    if exact_first:
+        for term in search_terms:
+            term_lower = term.lower().strip()
+            for col, col_lower in cols_lower.items():
+                if col_lower == term_lower:
+                    return col
+    
+    # Try partial matches
+    for term in search_terms:
+        term_lower = term.lower().strip()
+        for col, col_lower in cols_lower.items():
+            if term_lower in col_lower:
+                return col
+    
+    return None
+
+# NAICS prefix lengths tried from most to least specific
+NAICS_PREFIX_LENGTHS = [6, 5, 4, 3, 2]
+
+def normalize_naics(values):
+    """
+    Normalize NAICS values to integer codes
+    
+    Keeps the digits of each value (as the string comparison always has) and
+    right-pads them to 6 places, so a prefix of any length is an integer division.
+    
+    Returns:
+        Tuple of (int64 padded codes, number of digits in each original code)
+    """
+    digits = pd.Series(values).astype(str).str.replace(r'\D', '', regex=True).str[:6]
+    n_digits = digits.str.len().to_numpy()
+    codes = pd.to_numeric(digits.str.ljust(6, '0').where(n_digits > 0), errors='coerce')
+    return codes.fillna(0).astype(np.int64).to_numpy(), n_digits
+
+def read_only(*arrays):
+    """Mark arrays read-only, so a store shared between sessions cannot be changed through them"""
+    for values in arrays:
+        if values is not None:
+            values.flags.writeable = False
+
+class NaicsIndex:
+    """
+    Row positions of a dataset grouped by NAICS prefix, for every prefix length
+    
+    Within each prefix the rows are kept sorted by revenue, with a parallel
+    sorted revenue array, so a revenue window inside a prefix is a contiguous
+    slice found by binary search. Rows without revenue sort to the end of
+    their prefix.
+    
+    positions gives the dataset row position of each indexed row when the
+    index covers only part of the dataset (default: 0, 1, 2, ...). Keys are
+    stored as int32 and positions as uint32 (up to 4 billion rows).
+    """
+    
+    def __init__(self, codes, n_digits, revenue=None, positions=None):
+        if positions is None:
+            positions = np.arange(len(codes))
+        codes = np.asarray(codes, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.uint32)
+        self.levels = {}
+        for length in NAICS_PREFIX_LENGTHS:
+            # Codes shorter than the prefix can never match it
+            keys = np.where(n_digits >= length, codes // 10 ** (6 - length), -1).astype(np.int32)
+            if revenue is None:
+                order = np.argsort(keys, kind='stable')
+                self.levels[length] = (keys[order], positions[order], None)
+            else:
+                order = np.lexsort((revenue, keys))
+                self.levels[length] = (keys[order], positions[order], revenue[order])
+            read_only(*self.levels[length])
+    
+    @classmethod
+    def from_levels(cls, levels):
+        """Wrap previously built (keys, order, revenue) arrays, e.g. memory-mapped from disk"""
+        index = cls.__new__(cls)
+        index.levels = levels
+        for arrays in levels.values():
+            read_only(*arrays)
+        return index
+    
+    def merged(self, codes, n_digits, revenue, positions):
+        """
+        New index with extra rows added at the given dataset positions
+        
+        Only the new rows are sorted; they are then inserted into the existing
+        sorted arrays, so the cost is one pass over the index rather than a
+        full re-sort. The result is identical to rebuilding from scratch.
+        """
+        delta = NaicsIndex(codes, n_digits, revenue, positions)
+        levels = {}
+        
+        for length in NAICS_PREFIX_LENGTHS:
+            keys, order, sorted_revenue = self.levels[length]
+            new_keys, new_order, new_revenue = delta.levels[length]
+            
+            if sorted_revenue is None:
+                insert_at = np.searchsorted(keys, new_keys, side='right')
+            else:
+                # Within each prefix the new rows go after existing rows with equal revenue
+                insert_at = np.empty(len(new_keys), dtype=np.int64)
+                unique_keys, starts, counts = np.unique(new_keys, return_index=True, return_counts=True)
+                for key, start, count in zip(unique_keys, starts, counts):
+                    lo = np.searchsorted(keys, key, side='left')
+                    hi = np.searchsorted(keys, key, side='right')
+                    insert_at[start:start + count] = lo + np.searchsorted(
+                        sorted_revenue[lo:hi], new_revenue[start:start + count], side='right'
+                    )
+            
+            levels[length] = (
+                np.insert(keys, insert_at, new_keys),
+                np.insert(order, insert_at, new_order),
+                None if sorted_revenue is None else np.insert(sorted_revenue, insert_at, new_revenue)
+            )
+        
+        return NaicsIndex.from_levels(levels)
+    
+    def _bucket(self, prefix):
+        """Slice bounds of a prefix in the sorted arrays for its length"""
+        keys = self.levels[len(prefix)][0]
+        key = int(prefix)
+        return np.searchsorted(keys, key, side='left'), np.searchsorted(keys, key, side='right')
+    
+    def _window(self, prefix, min_revenue=None, max_revenue=None):
+        """Slice bounds of a prefix, narrowed to a revenue window if one is given"""
+        sorted_revenue = self.levels[len(prefix)][2]
+        lo, hi = self._bucket(prefix)
+        if sorted_revenue is not None and min_revenue is not None:
+            bucket_revenue = sorted_revenue[lo:hi]
+            lo, hi = (lo + np.searchsorted(bucket_revenue, min_revenue, side='left'),
+                      lo + np.searchsorted(bucket_revenue, max_revenue, side='right'))
+        return lo, hi
+    
+    def count(self, prefix, min_revenue=None, max_revenue=None):
+        """Number of rows whose NAICS code starts with the given digit prefix (and in the revenue window)"""
+        lo, hi = self._window(prefix, min_revenue, max_revenue)
+        return int(hi - lo)
+    
+    def level_counts(self, naics_clean):
+        """Number of rows sharing each prefix length of naics_clean, most specific first"""
+        return {length: self.count(naics_clean[:length]) for length in NAICS_PREFIX_LENGTHS if len(naics_clean) >= length}
+    
+    def positions(self, prefix, min_revenue=None, max_revenue=None):
+        """
+        Row positions whose NAICS code starts with the given digit prefix
+        
+        If a revenue window is given (and the index was built with revenue),
+        only rows with min_revenue <= revenue <= max_revenue are returned.
+        Positions come back in revenue order, not dataset order.
+        """
+        lo, hi = self._window(prefix, min_revenue, max_revenue)
+        return self.levels[len(prefix)][1][lo:hi]
+
+# Partition key for transactions without a year
+UNDATED_PARTITION = -1
+
+def year_partition_keys(years, n_rows):
+    """Partition key of each row: its whole transaction year, or UNDATED_PARTITION"""
+    keys = np.full(n_rows, UNDATED_PARTITION, dtype=np.int64)
+    if years is not None:
+        known = np.isfinite(years)
+        keys[known] = np.floor(years[known]).astype(np.int64)
+    return keys
+
+class PartitionedNaicsIndex:
+    """
+    NAICS/revenue index split into one NaicsIndex per transaction year
+    
+    A query with a year cut-off only visits the partitions for that year and
+    later, so a narrow window reads proportionally less of the index. Counts
+    without a cut-off add up a binary search per partition. Appending rows
+    only touches the partitions of the years they fall in - a new year's
+    deliveries add a partition and every existing one is reused as-is.
+    Rows without a year sit in UNDATED_PARTITION, which any cut-off skips.
+    """
+    
+    def __init__(self, partitions):
+        self.partitions = partitions
+    
+    @classmethod
+    def build(cls, codes, n_digits, revenue=None, years=None, positions=None):
+        """Index rows (at the given dataset positions, default 0, 1, 2, ...) by year"""
+        if positions is None:
+            positions = np.arange(len(codes))
+        keys = year_partition_keys(years, len(codes))
+        
+        # One sort groups the rows of each year together
+        order = np.argsort(keys, kind='stable')
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        ends = np.r_[starts[1:], len(order)]
+        
+        partitions = {}
+        for key, start, end in zip(unique_keys.tolist(), starts, ends):
+            rows = order[start:end]
+            partitions[key] = NaicsIndex(
+                codes[rows], n_digits[rows], None if revenue is None else revenue[rows], positions[rows]
+            )
+        return cls(partitions)
+    
+    def merged(self, codes, n_digits, revenue, years, offset):
+        """New index with extra rows appended at dataset positions offset, offset + 1, ..."""
+        keys = year_partition_keys(years, len(codes))
+        partitions = dict(self.partitions)
+        for key in np.unique(keys).tolist():
+            rows = np.flatnonzero(keys == key)
+            args = (codes[rows], n_digits[rows], None if revenue is None else revenue[rows], offset + rows)
+            partitions[key] = partitions[key].merged(*args) if key in partitions else NaicsIndex(*args)
+        return PartitionedNaicsIndex(partitions)
+    
+    def _selected(self, min_year):
+        """Partitions for min_year and later (all of them if min_year is None)"""
+        return [index for key, index in self.partitions.items() if min_year is None or key >= min_year]
+    
+    def count(self, prefix, min_revenue=None, max_revenue=None, min_year=None):
+        """Number of rows matching the prefix (and revenue window) from min_year onwards"""
+        return sum(index.count(prefix, min_revenue, max_revenue) for index in self._selected(min_year))
+    
+    def level_counts(self, naics_clean, min_year=None):
+        """
+        Histogram of NAICS match levels for a subject code
+        
+        Returns:
+            Dict of prefix length to the number of rows sharing that many
+            leading digits with naics_clean, most specific first
+        """
+        counts = dict.fromkeys((length for length in NAICS_PREFIX_LENGTHS if len(naics_clean) >= length), 0)
+        for index in self._selected(min_year):
+            for length, count in index.level_counts(naics_clean).items():
+                counts[length] += count
+        return counts
+    
+    def positions(self, prefix, min_revenue=None, max_revenue=None, min_year=None):
+        """
+        Row positions matching the prefix (and revenue window) from min_year onwards
+        
+        Positions are grouped by partition, not in dataset or revenue order.
+        """
+        selected = [index.positions(prefix, min_revenue, max_revenue) for index in self._selected(min_year)]
+        return np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+
+# Feature weights for nearest-neighbour comparables. Revenue, margin and age are
+# divided by their spread in the dataset first, so a weight of 1 makes one
+# standard deviation count as much as one step up the NAICS tree.
+NEIGHBOUR_WEIGHTS = {'naics': 1.0, 'revenue': 1.0, 'margin': 0.5, 'age': 0.5}
+
+# Buckets smaller than this are scanned directly instead of building a KD-tree
+NEIGHBOUR_TREE_MIN_ROWS = 64
+
+def neighbour_features(store, weights=NEIGHBOUR_WEIGHTS):
+    """
+    Scaled feature point of every transaction for nearest-neighbour search
+    
+    Features are log revenue, SDE margin and transaction year, each divided by
+    its spread among the rankable rows and multiplied by its weight.
+    
+    Returns:
+        Tuple of (float32 points of shape (rows, 3), bool mask of rankable
+        rows, dict of the 'scales', 'default_margin' and 'default_log_revenue'
+        used to place a subject among them)
+    """
+    revenue = store.column('revenue').astype(float)
+    valid = np.isfinite(revenue) & (revenue > 0)
+    log_revenue = np.log(np.where(valid, revenue, 1.0))
+    
+    if store.has('sde'):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            margin = np.clip(store.column('sde').astype(float) / revenue, -1.0, 1.0)
+        known = valid & np.isfinite(margin)
+        default_margin = float(np.median(margin[known])) if known.any() else 0.0
+        margin = np.where(known, margin, default_margin)
+    else:
+        margin = np.zeros(len(revenue))
+        default_margin = 0.0
+    
+    if store.has('year'):
+        year = store.column('year').astype(float)
+        known = valid & np.isfinite(year)
+        # Undated transactions rank as the oldest in the dataset
+        oldest = float(year[known].min()) if known.any() else 0.0
+        year = np.where(known, year, oldest)
+    else:
+        year = np.zeros(len(revenue))
+    
+    features = [log_revenue, margin, year]
+    scales = [
+        weight / (values[valid].std() or 1.0) if valid.any() else weight
+        for values, weight in zip(features, (weights['revenue'], weights['margin'], weights['age']))
+    ]
+    params = {
+        'scales': [float(scale) for scale in scales],
+        'default_margin': default_margin,
+        'default_log_revenue': float(np.median(log_revenue[valid])) if valid.any() else 0.0
+    }
+    points = (np.column_stack(features) * scales).astype(np.float32)
+    read_only(points, valid)
+    return points, valid, params
+
+class NeighbourIndex:
+    """
+    Nearest-neighbour search over PeerComps transactions
+    
+    A transaction's distance from the subject combines NAICS tree distance (how
+    many levels up the subject's code the two codes meet), log revenue, SDE
+    margin and transaction age. The feature points come from
+    neighbour_features() and are memory-mapped from the cache when the store
+    was opened from it. Each NAICS bucket, including the whole dataset at the
+    root, gets its own KD-tree over the points, built the first time it is
+    queried.
+    
+    nearest() queries the subject's bucket at every level for its k closest
+    rows and keeps the best k overall, stopping as soon as the NAICS distance
+    alone rules out the next level, so the result is the exact top k.
+    Rows without revenue are not ranked.
+    """
+    
+    def __init__(self, naics_index, points, valid, params, weights=NEIGHBOUR_WEIGHTS):
+        self.naics_index = naics_index
+        self.weights = weights
+        self.points = points
+        self.valid = valid
+        self.scales = np.asarray(params['scales'])
+        self.default_margin = params['default_margin']
+        self.default_log_revenue = params['default_log_revenue']
+        
+        self._buckets = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return int(self.valid.sum())
+    
+    def _bucket(self, length, prefix):
+        """Rankable row positions of a NAICS bucket and their KD-tree (None for small buckets)"""
+        key = (length, prefix)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if length == 0:
+                positions = np.flatnonzero(self.valid)
+            else:
+                positions = self.naics_index.positions(prefix)
+                positions = positions[self.valid[positions]]
+            tree = None
+            if cKDTree is not None and len(positions) >= NEIGHBOUR_TREE_MIN_ROWS:
+                tree = cKDTree(self.points[positions])
+            bucket = (positions, tree)
+            with self._lock:
+                self._buckets[key] = bucket
+        return bucket
+    
+    def tree_nbytes(self):
+        """Bytes held by the buckets built so far: their positions and KD-tree data and index buffers"""
+        with self._lock:
+            buckets = list(self._buckets.values())
+        total = 0
+        for positions, tree in buckets:
+            total += positions.nbytes
+            if tree is not None:
+                total += tree.data.nbytes + tree.indices.nbytes
+        return total
+    
+    def subject_point(self, revenue, sde_margin, year):
+        """Feature vector of the company being valued"""
+        log_revenue = np.log(revenue) if revenue and revenue > 0 else self.default_log_revenue
+        margin = self.default_margin if sde_margin is None else float(np.clip(sde_margin, -1.0, 1.0))
+        return np.array([log_revenue, margin, year]) * self.scales
+    
+    def nearest(self, naics_clean, point, k):
+        """
+        The k transactions closest to a subject
+        
+        Args:
+            naics_clean: Subject's NAICS digits
+            point: Subject's feature vector from subject_point()
+            k: Number of transactions to return
+        
+        Returns:
+            Tuple of (positions, distances, NAICS prefix length shared with the
+            subject), closest first
+        """
+        levels = [length for length in NAICS_PREFIX_LENGTHS if len(naics_clean) >= length] + [0]
+        best = {}
+        
+        for climb, length in enumerate(levels):
+            naics_distance = self.weights['naics'] * climb
+            if len(best) >= k and sorted(d for d, _ in best.values())[k - 1] <= naics_distance:
+                break
+            
+            positions, tree = self._bucket(length, naics_clean[:length])
+            n = min(k, len(positions))
+            if n == 0:
+                continue
+            if tree is not None:
+                distances, idx = tree.query(point, k=n)
+                distances, idx = np.atleast_1d(distances), np.atleast_1d(idx)
+            else:
+                distances = np.sqrt(((self.points[positions] - point) ** 2).sum(axis=1))
+                idx = np.argpartition(distances, n - 1)[:n]
+                distances = distances[idx]
+            
+            totals = np.sqrt(naics_distance ** 2 + distances ** 2)
+            for position, total in zip(positions[idx].tolist(), totals.tolist()):
+                # A row found again higher up the tree keeps its closer match
+                if position not in best or total < best[position][0]:
+                    best[position] = (total, length)
+        
+        ranked = sorted(best.items(), key=lambda item: (item[1][0], item[0]))[:k]
+        return (np.array([position for position, _ in ranked], dtype=np.int64),
+                np.array([total for _, (total, _) in ranked]),
+                np.array([length for _, (_, length) in ranked], dtype=np.int64))
+
+# Revenue bands (USD lower bounds) for industry multiple statistics
+MULTIPLE_REVENUE_BANDS = [0, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000]
+
+# Canonical PeerComps column each multiple is calculated from when it is blank
+PEERCOMPS_MULTIPLE_BASES = {'rev_mult': 'revenue', 'sde_mult': 'sde', 'ebitda_mult': 'ebitda'}
+
+# Fraction cut from each end for the trimmed mean
+MULTIPLE_TRIM = 0.1
+
+# Fewest transactions a NAICS group needs before its statistics are quoted
+MULTIPLE_STATS_MIN_COUNT = 5
+
+# Statistics MultipleStats keeps for each group
+MULTIPLE_STATISTICS = ['count', 'mean', 'median', 'trimmed_mean', 'p10', 'p25', 'p75', 'p90']
+
+def revenue_band_label(band):
+    """Display label of a MULTIPLE_REVENUE_BANDS band (0 = all revenues, 1 = first band, ...)"""
+    if band == 0:
+        return "All revenues"
+    lower = MULTIPLE_REVENUE_BANDS[band - 1]
+    if band == len(MULTIPLE_REVENUE_BANDS):
+        return f"${lower:,}+ USD"
+    return f"${lower:,} - ${MULTIPLE_REVENUE_BANDS[band]:,} USD"
+
+def grouped_statistics(keys, values):
+    """
+    Count, mean, median, trimmed mean and P10/P25/P75/P90 of values per key
+    
+    values must already be sorted; a stable sort on keys then leaves each
+    group's values contiguous and in order, so every statistic is read off
+    the group boundaries and a running sum in one pass. Keys are hashed to
+    dense group codes first, so the sort runs on 16-bit codes (a radix sort)
+    whenever there are few enough groups.
+    
+    Returns:
+        Tuple of (group keys, in no particular order, and dict of statistic
+        name to per-group array)
+    """
+    codes, unique_keys = pd.factorize(keys)
+    if len(unique_keys) <= np.iinfo(np.uint16).max:
+        codes = codes.astype(np.uint16)
+    order = np.argsort(codes, kind='stable')
+    keys, values = unique_keys[codes[order]], values[order]
+    if len(keys) == 0:
+        return keys, {}
+    
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+    counts = ends - starts
+    running = np.r_[0.0, np.cumsum(values)]
+    
+    def quantile(q):
+        # Linear interpolation between closest ranks, as np.quantile does
+        position = starts + q * (counts - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, ends - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+    
+    trim = np.floor(counts * MULTIPLE_TRIM).astype(np.int64)
+    stats = {
+        'count': counts,
+        'mean': (running[ends] - running[starts]) / counts,
+        'median': quantile(0.5),
+        'trimmed_mean': (running[ends - trim] - running[starts + trim]) / (counts - 2 * trim),
+        'p10': quantile(0.1),
+        'p25': quantile(0.25),
+        'p75': quantile(0.75),
+        'p90': quantile(0.9)
+    }
+    return keys[starts], stats
+
+def multiple_group_keys(length, prefixes, bands):
+    """Sortable int64 key of each (NAICS prefix length, prefix, revenue band) statistics group"""
+    return (length * 10 ** 6 + np.asarray(prefixes, dtype=np.int64)) * 16 + bands
+
+class MultipleStats:
+    """
+    Precomputed valuation multiple statistics per NAICS prefix and revenue band
+    
+    For every NAICS prefix (2 to 6 digits, plus the whole dataset) and every
+    revenue band (plus all revenues) the table holds count, mean, median,
+    trimmed mean and P10/P25/P75/P90 of each multiple. Multiples the dataset
+    leaves blank are calculated from the sale price where possible;
+    non-positive multiples are left out.
+    
+    tables maps each multiple to its sorted group keys (multiple_group_keys)
+    and one array per statistic, so the table is saved with the store and
+    memory-mapped by every worker, and looking up a group is a binary search.
+    """
+    
+    def __init__(self, tables):
+        self.tables = tables
+        for keys, stats in tables.values():
+            read_only(keys, *stats.values())
+    
+    @classmethod
+    def build(cls, store):
+        """Compute the statistics of every group from the store's columns"""
+        codes = store.column('naics_code').astype(np.int64)
+        n_digits = store.column('naics_digits')
+        revenue = store.column('revenue').astype(float) if store.has('revenue') else np.full(len(store), np.nan)
+        price = store.column('price').astype(float) if store.has('price') else np.full(len(store), np.nan)
+        
+        # Band 0 is all revenues; rows without revenue only count there
+        bands = np.searchsorted(MULTIPLE_REVENUE_BANDS, np.nan_to_num(revenue, nan=-1.0), side='right')
+        
+        tables = {}
+        for field, base_col in PEERCOMPS_MULTIPLE_BASES.items():
+            values = store.column(field).astype(float) if store.has(field) else np.full(len(store), np.nan)
+            if store.has(base_col):
+                base = store.column(base_col).astype(float)
+                missing = ~(values > 0) & (price > 0) & (base > 0)
+                values = np.where(missing, price / np.where(missing, base, 1.0), values)
+            
+            valid = np.isfinite(values) & (values > 0)
+            order = np.flatnonzero(valid)[np.argsort(values[valid], kind='stable')]
+            sorted_values = values[order]
+            
+            group_keys, group_stats = [], []
+            for length in NAICS_PREFIX_LENGTHS + [0]:
+                prefixes = codes[order] // 10 ** (6 - length) if length else np.zeros(len(order), dtype=np.int64)
+                in_level = n_digits[order] >= length
+                for by_band in (False, True):
+                    group_bands = bands[order] if by_band else np.zeros(len(order), dtype=np.int64)
+                    keep = in_level & (group_bands > 0) if by_band else in_level
+                    keys, stats = grouped_statistics(
+                        multiple_group_keys(length, prefixes, group_bands)[keep], sorted_values[keep]
+                    )
+                    if len(keys):
+                        group_keys.append(keys)
+                        group_stats.append(stats)
+            
+            if not group_keys:
+                continue
+            keys = np.concatenate(group_keys)
+            order = np.argsort(keys, kind='stable')
+            tables[field] = (keys[order], {
+                name: np.concatenate([stats[name] for stats in group_stats])[order]
+                for name in MULTIPLE_STATISTICS
+            })
+        return cls(tables)
+    
+    def __len__(self):
+        return sum(len(keys) for keys, _ in self.tables.values())
+    
+    def lookup(self, naics_clean, revenue=None, min_count=MULTIPLE_STATS_MIN_COUNT):
+        """
+        Statistics of each multiple for the most specific group with enough data
+        
+        Groups are tried from the longest NAICS prefix of naics_clean down to
+        the whole dataset; at each prefix the subject's revenue band (if revenue
+        is given, in USD) is tried before all revenues. Values are rounded to 6
+        decimals as they are read out, so float32 storage noise stays out of
+        reports.
+        
+        Returns:
+            Dict of multiple field to its statistics, plus 'naics_prefix' and
+            'revenue_band' naming the group they came from
+        """
+        band = int(np.searchsorted(MULTIPLE_REVENUE_BANDS, revenue, side='right')) if revenue and revenue > 0 else 0
+        
+        # Candidate groups, most specific first
+        groups = [
+            (length, group_band)
+            for length in [length for length in NAICS_PREFIX_LENGTHS if len(naics_clean) >= length] + [0]
+            for group_band in ([band, 0] if band else [0])
+        ]
+        lengths, group_bands = np.array(groups, dtype=np.int64).T
+        prefixes = [int(naics_clean[:length]) if length else 0 for length, _ in groups]
+        candidates = multiple_group_keys(lengths, prefixes, group_bands)
+        
+        result = {}
+        for field, (keys, stats) in self.tables.items():
+            at = np.minimum(np.searchsorted(keys, candidates), len(keys) - 1)
+            found = (keys[at] == candidates) & (stats['count'][at] >= min_count)
+            if not found.any():
+                continue
+            first = int(np.argmax(found))
+            i = at[first]
+            length, group_band = groups[first]
+            result[field] = {name: round(stats[name][i].item(), 6) for name in MULTIPLE_STATISTICS}
+            result[field].update(
+                naics_prefix=naics_clean[:length] or "All",
+                revenue_band=revenue_band_label(group_band)
+            )
+        return result
+
+# Compact storage dtype of each canonical field. Text fields are dictionary-encoded
+# instead (see encode_labels) and blank years are stored as MISSING_YEAR.
+STORE_DTYPES = {
+    'naics_code': np.uint32, 'naics_digits': np.uint8, 'year': np.uint16,
+    'revenue': np.float32, 'price': np.float32, 'sde': np.float32, 'ebitda': np.float32,
+    'rev_mult': np.float32, 'sde_mult': np.float32, 'ebitda_mult': np.float32,
+    'fingerprint': np.uint64
+}
+STORE_TEXT_FIELDS = ['naics']
+MISSING_YEAR = 0
+
+def encode_store_column(name, values):
+    """Convert a canonical (non-text) column to its compact storage dtype"""
+    values = np.asarray(values)
+    if name == 'year':
+        years = values.astype(float)
+        known = np.isfinite(years) & (years >= 1) & (years <= np.iinfo(np.uint16).max)
+        stored = np.full(len(years), MISSING_YEAR, dtype=np.uint16)
+        stored[known] = np.floor(years[known])
+        return stored
+    return values.astype(STORE_DTYPES.get(name, values.dtype))
+
+def decode_years(stored):
+    """Float years from the stored uint16 column, NaN where the year is blank"""
+    years = stored.astype(np.float32)
+    years[stored == MISSING_YEAR] = np.nan
+    return years
+
+def encode_labels(labels, categories=None):
+    """
+    Dictionary-encode text labels
+    
+    Labels are looked up in categories (the vocabulary of an existing column)
+    and labels not seen before are appended to it.
+    
+    Returns:
+        Tuple of (uint32 codes, categories)
+    """
+    labels = pd.Index(np.asarray(labels, dtype=str))
+    vocabulary = pd.Index(np.empty(0, dtype=str) if categories is None else categories)
+    codes = vocabulary.get_indexer(labels)
+    unseen = codes < 0
+    if unseen.any():
+        extra = pd.Index(pd.unique(labels[unseen]))
+        codes[unseen] = len(vocabulary) + extra.get_indexer(labels[unseen])
+        vocabulary = vocabulary.append(extra)
+    return codes.astype(np.uint32), vocabulary.to_numpy().astype(str)
+
+class PeerCompsStore:
+    """
+    Immutable PeerComps dataset, safe to share between sessions and threads
+    
+    Holds the canonical columns as read-only NumPy arrays together with the
+    year-partitioned NAICS/revenue index. The nearest-neighbour index is
+    built on the first nearest-neighbour query, over feature points that
+    save() writes with the columns; the industry multiple statistics
+    (MultipleStats) are saved the same way and computed on first use when the
+    store was not opened from a saved directory.
+    Columns are kept in compact dtypes (STORE_DTYPES) with text fields
+    dictionary-encoded against a vocabulary in categories; column(), view()
+    and rows() decode them back to text labels and float years. Numeric
+    columns are wrapped without copying; writing through them raises instead
+    of changing the shared data.
+    
+    A store is either built in memory from the canonical frame (from_frame) or
+    memory-mapped from a directory written by save() (open). The directory holds
+    one .npy file per column, vocabulary and index array plus store.json. append()
+    returns a new store; the original is never modified.
+    
+    info holds the store's provenance: 'version', 'source_sha256' (hash of the
+    main workbook), 'deltas' (hashes of ingested delta workbooks),
+    'source_columns', 'schema' and 'duplicates_removed' (repeated
+    transactions dropped while loading and ingesting).
+    """
+    
+    def __init__(self, columns, naics_index, info, categories=None, neighbour_arrays=None, multiple_stats=None):
+        self._columns = columns
+        self.categories = categories or {}
+        read_only(*self.categories.values())
+        self.naics_index = naics_index
+        self.info = info
+        self.version = info['version']
+        self.source_sha256 = info['source_sha256']
+        self.deltas = list(info['deltas'])
+        self.source_columns = list(info['source_columns'])
+        self.schema = dict(info['schema'])
+        self.duplicates_removed = info.get('duplicates_removed', 0)
+        self._sorted_fingerprints = None
+        self._conversion_rates = None
+        self._neighbour_arrays = neighbour_arrays
+        self._neighbours = None
+        self._multiple_stats = multiple_stats
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_frame(cls, df):
+        """Build a store (and its index) from a canonical PeerComps frame"""
+        columns, categories = {}, {}
+        for name in df.columns:
+            if name in STORE_TEXT_FIELDS:
+                values, categories[name] = encode_labels(df[name].to_numpy())
+            else:
+                values = np.array(encode_store_column(name, df[name].to_numpy()), copy=True)
+            values.flags.writeable = False
+            columns[name] = values
+        
+        naics_index = None
+        if 'naics' in columns:
+            naics_index = PartitionedNaicsIndex.build(
+                columns['naics_code'], columns['naics_digits'], columns.get('revenue'),
+                decode_years(columns['year']) if 'year' in columns else None
+            )
+        
+        info = {
+            'version': df.attrs['version'],
+            'source_sha256': df.attrs['version'],
+            'deltas': [],
+            'source_columns': df.attrs['source_columns'],
+            'schema': df.attrs['schema'],
+            'duplicates_removed': df.attrs.get('duplicates_removed', 0)
+        }
+        return cls(columns, naics_index, info, categories)
+    
+    @classmethod
+    def open(cls, path):
+        """Memory-map a store saved with save(); pages are shared with other processes"""
+        with open(os.path.join(path, 'store.json')) as f:
+            info = json.load(f)
+        
+        load = lambda name: np.asarray(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        columns = {name: load(f'col_{name}') for name in info['columns']}
+        categories = {name: load(f'cat_{name}') for name in info['categories']}
+        
+        naics_index = None
+        if info['naics_index']:
+            naics_index = PartitionedNaicsIndex({
+                key: NaicsIndex.from_levels({
+                    length: (load(f'naics{length}_y{key}_keys'), load(f'naics{length}_y{key}_order'),
+                             load(f'naics{length}_y{key}_revenue') if info['naics_index_revenue'] else None)
+                    for length in NAICS_PREFIX_LENGTHS
+                })
+                for key in info['naics_partitions']
+            })
+        
+        features = None
+        if info.get('neighbour_params'):
+            features = (load('neighbour_points'), load('neighbour_valid'), info['neighbour_params'])
+        
+        multiple_stats = None
+        if info.get('multiple_stats') is not None:
+            multiple_stats = MultipleStats({
+                field: (load(f'stats_{field}_keys'), {name: load(f'stats_{field}_{name}') for name in MULTIPLE_STATISTICS})
+                for field in info['multiple_stats']
+            })
+        
+        return cls(columns, naics_index, info, categories, features, multiple_stats)
+    
+    def save(self, path):
+        """Write every column and index array to its own .npy file under path"""
+        os.makedirs(path)
+        for name, values in self._columns.items():
+            np.save(os.path.join(path, f'col_{name}.npy'), values)
+        for name, values in self.categories.items():
+            np.save(os.path.join(path, f'cat_{name}.npy'), values)
+        
+        has_revenue = False
+        partitions = []
+        if self.naics_index is not None:
+            for key, index in self.naics_index.partitions.items():
+                partitions.append(key)
+                for length, (keys, order, sorted_revenue) in index.levels.items():
+                    np.save(os.path.join(path, f'naics{length}_y{key}_keys.npy'), keys)
+                    np.save(os.path.join(path, f'naics{length}_y{key}_order.npy'), order)
+                    if sorted_revenue is not None:
+                        has_revenue = True
+                        np.save(os.path.join(path, f'naics{length}_y{key}_revenue.npy'), sorted_revenue)
+        
+        neighbour_params = None
+        if self.supports_neighbours:
+            points, valid, neighbour_params = self.neighbour_arrays()
+            np.save(os.path.join(path, 'neighbour_points.npy'), points)
+            np.save(os.path.join(path, 'neighbour_valid.npy'), valid)
+        
+        multiple_stats = None
+        if self.multiple_stats is not None:
+            multiple_stats = list(self.multiple_stats.tables)
+            for field, (keys, stats) in self.multiple_stats.tables.items():
+                np.save(os.path.join(path, f'stats_{field}_keys.npy'), keys)
+                for name, values in stats.items():
+                    np.save(os.path.join(path, f'stats_{field}_{name}.npy'), values)
+        
+        with open(os.path.join(path, 'store.json'), 'w') as f:
+            json.dump(dict(
+                self.info,
+                columns=list(self._columns),
+                categories=list(self.categories),
+                naics_index=self.naics_index is not None,
+                naics_index_revenue=has_revenue,
+                naics_partitions=partitions,
+                neighbour_params=neighbour_params,
+                multiple_stats=multiple_stats
+            ), f)
+    
+    def append(self, delta_df, delta_sha256):
+        """
+        New store with the rows of a canonical delta frame appended
+        
+        Rows whose fingerprint is already in the store, or repeated within the
+        delta, are dropped. The version becomes a hash of the previous version
+        and the delta, so anything keyed on it is invalidated.
+        
+        Returns:
+            Tuple of (new store, rows added, duplicates skipped)
+        """
+        delta_df, duplicates = drop_duplicate_transactions(delta_df)
+        known = self.contains(delta_df['fingerprint'].to_numpy())
+        delta_df = delta_df[~known]
+        duplicates += int(known.sum())
+        offset = len(self)
+        
+        columns, categories = {}, dict(self.categories)
+        for name, values in self._columns.items():
+            if name in categories:
+                # Fields missing from the delta workbook are left blank
+                labels = delta_df[name].to_numpy() if name in delta_df.columns else np.full(len(delta_df), '')
+                new_values, categories[name] = encode_labels(labels, categories[name])
+            elif name in delta_df.columns:
+                new_values = encode_store_column(name, delta_df[name].to_numpy())
+            else:
+                blank = np.nan if values.dtype.kind == 'f' else 0
+                new_values = np.full(len(delta_df), blank, dtype=values.dtype)
+            combined = np.concatenate([values, new_values])
+            combined.flags.writeable = False
+            columns[name] = combined
+        
+        naics_index = self.naics_index
+        if naics_index is not None:
+            naics_index = naics_index.merged(
+                columns['naics_code'][offset:],
+                columns['naics_digits'][offset:],
+                columns['revenue'][offset:] if 'revenue' in columns else None,
+                decode_years(columns['year'][offset:]) if 'year' in columns else None,
+                offset
+            )
+        
+        info = dict(
+            self.info,
+            version=hashlib.sha256(f"{self.version}:{delta_sha256}".encode()).hexdigest(),
+            deltas=self.deltas + [delta_sha256],
+            duplicates_removed=self.duplicates_removed + duplicates
+        )
+        return PeerCompsStore(columns, naics_index, info, categories), len(delta_df), duplicates
+    
+    @property
+    def supports_neighbours(self):
+        """Whether nearest-neighbour search is possible (it needs the NAICS tree and revenue)"""
+        return self.naics_index is not None and 'revenue' in self._columns
+    
+    def neighbour_arrays(self):
+        """Feature points for nearest-neighbour search (see neighbour_features()), computed once"""
+        if self._neighbour_arrays is None:
+            self._neighbour_arrays = neighbour_features(self)
+        return self._neighbour_arrays
+    
+    @property
+    def neighbours(self):
+        """
+        NeighbourIndex of the store, or None if it cannot support one
+        
+        Built on the first nearest-neighbour query rather than with the store,
+        so opening or appending to a store never pays for it.
+        """
+        if self._neighbours is None and self.supports_neighbours:
+            with self._lock:
+                if self._neighbours is None:
+                    self._neighbours = NeighbourIndex(self.naics_index, *self.neighbour_arrays())
+        return self._neighbours
+    
+    @property
+    def multiple_stats(self):
+        """MultipleStats of the store (None without a NAICS column), computed on first use unless mapped from the cache"""
+        if self._multiple_stats is None and self.naics_index is not None:
+            with self._lock:
+                if self._multiple_stats is None:
+                    self._multiple_stats = MultipleStats.build(self)
+        return self._multiple_stats
+    
+    def contains(self, fingerprints):
+        """
+        Whether each fingerprint belongs to a transaction already in the store
+        
+        The store's fingerprints are sorted once, on first use, and each lookup
+        is a binary search.
+        """
+        if self._sorted_fingerprints is None:
+            self._sorted_fingerprints = np.sort(self._columns['fingerprint'])
+        known = self._sorted_fingerprints
+        if len(known) == 0:
+            return np.zeros(len(fingerprints), dtype=bool)
+        at = np.minimum(np.searchsorted(known, fingerprints), len(known) - 1)
+        return known[at] == fingerprints
+    
+    def conversion_rates(self, fx, default):
+        """
+        USD to CAD rate of every row at its transaction year
+        
+        Computed once per FX table and kept for the life of this store (one
+        dataset version). Sessions share the store, so the cache is read once
+        into a local and replaced whole; the returned rates are read-only.
+        
+        Args:
+            fx: FxRates
+            default: Rate for rows without a year
+        """
+        key = (fx.version, default)
+        cached = self._conversion_rates
+        if cached is None or cached[0] != key:
+            years = self.column('year') if self.has('year') else np.full(len(self), np.nan)
+            rates = fx.rates_for(years, default)
+            read_only(rates)
+            cached = (key, rates)
+            self._conversion_rates = cached
+        return cached[1]
+    
+    def __len__(self):
+        return len(next(iter(self._columns.values()))) if self._columns else 0
+    
+    @property
+    def columns(self):
+        return list(self._columns)
+    
+    def has(self, field):
+        """Whether a canonical field was found in the source dataset"""
+        return field in self._columns
+    
+    def _decode(self, name, values):
+        """Canonical values of stored column values: text labels, float years, numbers as stored"""
+        if name in self.categories:
+            return self.categories[name][values]
+        if name == 'year':
+            return decode_years(values)
+        return values
+    
+    def column(self, field):
+        """Read-only array of one canonical field (decoded; see _decode)"""
+        return self._decode(field, self._columns[field])
+    
+    def view(self):
+        """DataFrame over the shared arrays (only text and year columns are decoded into copies)"""
+        return pd.DataFrame({name: self._decode(name, values) for name, values in self._columns.items()}, copy=False)
+    
+    def rows(self, positions):
+        """DataFrame of the given row positions (copies only those rows)"""
+        return pd.DataFrame({name: self._decode(name, values[positions]) for name, values in self._columns.items()},
+                            copy=False)
+    
+    def memory_report(self):
+        """
+        Bytes held by the dataset and each of its indexes, compared with the float64/int64 layout
+        
+        The previous layout kept every number as 8 bytes, NAICS labels as
+        fixed-width text as wide as the longest label and neighbour points as
+        float64. Only the parts built or mapped so far count: the KD-trees grow
+        as NAICS buckets are first queried, and are private to each process
+        where everything else is mapped from the cache.
+        
+        Returns:
+            Dict of part ('columns', 'naics_index', 'neighbour_points',
+            'neighbour_trees', 'multiple_stats', 'total') to a tuple of
+            (bytes in the previous layout, bytes now)
+        """
+        n_rows = len(self)
+        columns_now = sum(values.nbytes for values in self._columns.values())
+        columns_now += sum(values.nbytes for values in self.categories.values())
+        columns_before = sum(
+            n_rows * (self.categories[name].dtype.itemsize if name in self.categories else 8)
+            for name in self._columns
+        )
+        
+        index_before = index_now = 0
+        if self.naics_index is not None:
+            for index in self.naics_index.partitions.values():
+                for arrays in index.levels.values():
+                    arrays = [values for values in arrays if values is not None]
+                    index_now += sum(values.nbytes for values in arrays)
+                    index_before += sum(len(values) * 8 for values in arrays)
+        
+        points_before = points_now = 0
+        if self._neighbour_arrays is not None:
+            points, valid, _ = self._neighbour_arrays
+            points_now = points.nbytes + valid.nbytes
+            points_before = points.size * 8 + valid.nbytes
+        
+        trees = self._neighbours.tree_nbytes() if self._neighbours is not None else 0
+        
+        stats = 0
+        if self._multiple_stats is not None:
+            for keys, values in self._multiple_stats.tables.values():
+                stats += keys.nbytes + sum(column.nbytes for column in values.values())
+        
+        report = {
+            'columns': (columns_before, columns_now),
+            'naics_index': (index_before, index_now),
+            'neighbour_points': (points_before, points_now),
+            'neighbour_trees': (trees, trees),
+            'multiple_stats': (stats, stats)
+        }
+        report['total'] = tuple(sum(part) for part in zip(*report.values()))
+        return report
+
+# Bounded LRU cache of comparables queries
+COMPARABLES_CACHE_SIZE = 256
+
+class ComparablesCache:
+    """
+    LRU cache of comparables query results with hit/miss counters
+    
+    Entries belong to one dataset version; when a query arrives for a different
+    version (the dataset was reloaded) every entry is dropped.
+    """
+    
+    def __init__(self, max_entries=COMPARABLES_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    def get(self, version, key):
+        """Return the cached value for key, or None"""
+        with self._lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+    
+    def put(self, version, key, value):
+        """Store a value, evicting the least recently used entry when full"""
+        with self._lock:
+            if version != self.version:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+def bucket_revenue(revenue, significant_digits=4):
+    """Round revenue to a few significant digits so near-identical queries share a cache entry"""
+    if not revenue or revenue <= 0 or not np.isfinite(revenue):
+        return 0
+    return float(f"{revenue:.{significant_digits}g}")
+
+# Multiples used when no PeerComps data is available at all
+DEFAULT_MULTIPLES = {"rev_mult": 0.84, "sde_mult": 3.7, "ebitda_mult": 4.45}
+
+def comparable_multiple(transactions, field, industry_multiples):
+    """
+    Average a multiple over the comparables
+    
+    Comparables above the industry's upper outlier fence (P75 + 1.5 x IQR)
+    are left out. Without usable comparables the industry's trimmed mean is
+    used, and without industry data DEFAULT_MULTIPLES.
+    """
+    stats = industry_multiples.get(field)
+    values = [t[field] for t in transactions if t[field] > 0]
+    if stats:
+        fence = stats['p75'] + 1.5 * (stats['p75'] - stats['p25'])
+        values = [value for value in values if value <= fence]
+    
+    if values:
+        return round(sum(values) / len(values), 2)
+    if stats:
+        return round(stats['trimmed_mean'], 2)
+    return DEFAULT_MULTIPLES[field]
+
+class ComparablesResult:
+    """
+    Comparable transactions found for one query, with diagnostics
+    
+    Attributes:
+        transactions: List of transaction dicts (amounts in CAD)
+        method: 'nearest', 'filter', or 'sample' when synthetic transactions
+            were substituted
+        naics_prefix: NAICS prefix the search matched on ('filter' method), or
+            the subject's NAICS digits ('nearest' method)
+        counts: Rows remaining after each step, in order - 'naics', 'revenue'
+            and 'year' for the filter method, 'ranked' for the nearest method,
+            then 'returned'
+        match_levels: Number of returned transactions by NAICS prefix length
+            shared with the subject (0 = different sector; nearest method only)
+        messages: List of (level, text) diagnostics; level is 'info',
+            'warning' or 'success'
+        level_counts: Number of dataset transactions sharing each NAICS
+            prefix length with the subject, most specific first
+    """
+    
+    def __init__(self, transactions, method, naics_prefix='', counts=None, match_levels=None, messages=None,
+                 level_counts=None):
+        self.transactions = transactions
+        self.method = method
+        self.naics_prefix = naics_prefix
+        self.counts = counts or {}
+        self.match_levels = match_levels or {}
+        self.messages = messages or []
+        self.level_counts = level_counts or {}
+    
+    @property
+    def warnings(self):
+        """Text of the warning diagnostics"""
+        return [text for level, text in self.messages if level == 'warning']
+    
+    def copy(self):
+        """Result with its own transaction records, so a cached result stays intact"""
+        return ComparablesResult(
+            [dict(t) for t in self.transactions], self.method, self.naics_prefix,
+            dict(self.counts), dict(self.match_levels), list(self.messages), dict(self.level_counts)
+        )
+
+class FxRates:
+    """
+    USD to CAD exchange rates by transaction year
+    
+    PeerComps transactions are dated by year, so monthly rates are averaged per
+    year. A year missing from the table uses the closest earlier year, or the
+    first year for transactions before the table starts.
+    """
+    
+    def __init__(self, years, rates, version):
+        self.years = np.asarray(years, dtype=np.int64)
+        self.rates = np.asarray(rates, dtype=float)
+        self.version = version
+    
+    @property
+    def latest(self):
+        """Rate of the most recent year in the table"""
+        return float(self.rates[-1])
+    
+    def rates_for(self, years, default):
+        """
+        Rate for each transaction year in one searchsorted pass
+        
+        Args:
+            years: Transaction years (NaN where unknown)
+            default: Rate for transactions without a year
+        
+        Returns:
+            Float array of rates, one per year
+        """
+        years = np.asarray(years, dtype=float)
+        known = np.isfinite(years)
+        at = np.searchsorted(self.years, np.floor(years[known]), side='right') - 1
+        rates = np.full(len(years), float(default))
+        rates[known] = self.rates[np.maximum(at, 0)]
+        return rates
+
+def read_fx_rates(path=FX_RATES_PATH):
+    """
+    Load the local USD to CAD rate table
+    
+    The CSV needs 'year' and 'rate' columns and may have a 'month' column
+    (column names are matched case-insensitively).
+    
+    Returns:
+        FxRates, or None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    
+    df = pd.read_csv(path)
+    df.columns = [str(col).strip().lower() for col in df.columns]
+    missing = {'year', 'rate'} - set(df.columns)
+    if missing:
+        raise ValueError(f"FX rate table {path} is missing columns: {', '.join(sorted(missing))}")
+    
+    year = pd.to_numeric(df['year'], errors='coerce')
+    rate = pd.to_numeric(df['rate'], errors='coerce')
+    valid = year.notna() & (rate > 0)
+    annual = rate[valid].groupby(year[valid].astype(np.int64)).mean()
+    if annual.empty:
+        raise ValueError(f"FX rate table {path} has no usable rates")
+    return FxRates(annual.index.to_numpy(), annual.to_numpy(), file_sha256(path))
+
+def sample_result(revenue, usd_to_cad, naics_prefix='', counts=None, messages=None, level_counts=None):
+    """Result holding the synthetic transactions from generate_sample_comparables"""
+    return ComparablesResult(generate_sample_comparables(revenue, usd_to_cad), 'sample', naics_prefix, counts, None,
+                             messages, level_counts)
+
+def choose_naics_level(level_counts, min_matches=1):
+    """
+    NAICS prefix length to search at, from a histogram of match levels
+    
+    The most specific level with at least min_matches transactions; if none
+    has that many, the least specific level with any. None if nothing matches.
+    """
+    for length, count in level_counts.items():
+        if count >= max(min_matches, 1):
+            return length
+    nonempty = [length for length, count in level_counts.items() if count > 0]
+    return nonempty[-1] if nonempty else None
+
+def find_comparables(store, naics_code, revenue, year_range=5, max_results=20, usd_to_cad=1.40,
+                     sde=None, method='nearest', current_year=None, cache=None, min_matches=1, fx=None):
+    """
+    Find comparable transactions in a PeerComps store
+    
+    If a ComparablesCache is given, results are memoized per dataset version
+    keyed on the normalized NAICS code, the revenue (rounded to 4 significant
+    digits), the SDE margin (3 decimals), the method, the year range,
+    max_results, min_matches and the exchange rates.
+    
+    Args:
+        store: PeerCompsStore, or None to get sample transactions
+        naics_code: NAICS code to search for (text descriptions are ignored)
+        revenue: Company's revenue for filtering
+        year_range: How many years back to look ('filter' method only)
+        max_results: Maximum number of comparables to return
+        usd_to_cad: USD to CAD exchange rate (for transactions without a
+            year when fx is given)
+        sde: Company's SDE, used for the SDE margin ('nearest' method only)
+        method: 'nearest' ranks every transaction by similarity; 'filter' narrows
+            by NAICS prefix, revenue window and year cut-off
+        current_year: Year the search is run in (default: this year)
+        cache: Optional ComparablesCache
+        min_matches: Fewest transactions a NAICS prefix needs before the
+            filter method searches at that level (see choose_naics_level)
+        fx: Optional FxRates to convert each transaction at its year's rate
+    
+    Returns:
+        ComparablesResult
+    """
+    if store is None or len(store) == 0:
+        # Return sample data if dataset not available
+        return sample_result(revenue, usd_to_cad)
+    
+    # Extract numeric NAICS code (remove any text descriptions)
+    naics_clean = ''.join(filter(str.isdigit, str(naics_code)))
+    sde_margin = round(sde / revenue, 3) if sde is not None and revenue and revenue > 0 else None
+    revenue = bucket_revenue(revenue)
+    current_year = current_year or datetime.now().year
+    
+    key = (method, naics_clean, revenue, sde_margin, year_range, max_results, usd_to_cad, current_year, min_matches,
+           fx.version if fx is not None else None)
+    result = cache.get(store.version, key) if cache is not None else None
+    if result is None:
+        if method == 'nearest' and store.neighbours is not None:
+            result = search_nearest_comparables(store, naics_clean, revenue, sde_margin, max_results, usd_to_cad, current_year,
+                                                fx)
+        else:
+            result = search_comparables(store, naics_clean, revenue, year_range, max_results, usd_to_cad, current_year,
+                                        min_matches, fx)
+        if cache is not None:
+            cache.put(store.version, key, result)
+    
+    # Callers get their own records so the cached ones stay intact
+    return result.copy()
+
+def find_industry_multiples(store, naics_code, revenue):
+    """
+    Industry multiple statistics from the store's precomputed table
+    
+    Args:
+        store: PeerCompsStore, or None
+        naics_code: NAICS code (text descriptions are ignored)
+        revenue: Company's revenue in USD, to pick the revenue band
+    
+    Returns:
+        Dict from MultipleStats.lookup(), or {} if the dataset is unavailable
+    """
+    if store is None or store.multiple_stats is None:
+        return {}
+    naics_clean = ''.join(filter(str.isdigit, str(naics_code)))
+    return store.multiple_stats.lookup(naics_clean, revenue)
+
+def search_comparables(store, naics_clean, revenue, year_range, max_results, usd_to_cad, current_year, min_matches=1,
+                       fx=None):
+    """
+    Search the PeerComps store for comparable transactions
+    
+    Narrows by NAICS prefix (the longest with at least min_matches
+    transactions), then a revenue window of 50%-200% of revenue, then the
+    last year_range years.
+    
+    Returns:
+        ComparablesResult
+    """
+    messages = []
+    counts = {}
+    
+    # Canonical columns were resolved and typed when the dataset loaded
+    present = lambda name: name if store.has(name) else None
+    has_year = store.has('year')
+    has_revenue = store.has('revenue')
+    
+    # Debug info
+    if not store.has('naics'):
+        available_cols = ", ".join(store.source_columns[:10])
+        messages.append(('warning', f"Could not find NAICS column. Available columns: {available_cols}... Using sample data."))
+        return sample_result(revenue, usd_to_cad, messages=messages)
+    
+    # Current year for filtering
+    min_year = current_year - year_range
+    
+    # Filter by NAICS code (match first 2-6 digits depending on specificity)
+    naics_index = store.naics_index
+    level_counts = naics_index.level_counts(naics_clean)
+    length = choose_naics_level(level_counts, min_matches)
+    
+    if length is None:
+        messages.append(('warning', f"No NAICS matches found for {naics_clean}. Using sample data."))
+        return sample_result(revenue, usd_to_cad, counts={'naics': 0}, level_counts=level_counts, messages=messages)
+    
+    naics_prefix = naics_clean[:length]
+    match_count = counts['naics'] = level_counts[length]
+    messages.append(('info', "Transactions by NAICS match: " + ", ".join(f"{n}-digit {count}" for n, count in level_counts.items())))
+    messages.append(('info', f"Found {match_count} transactions matching NAICS prefix: {naics_prefix} ({length} digits)"))
+    
+    # Filter by similar revenue (within 50% to 200% of target) - a slice of the revenue-sorted prefix
+    min_revenue = max_revenue = None
+    if has_revenue and revenue > 0:
+        min_revenue, max_revenue = revenue * 0.5, revenue * 2.0
+        counts['revenue'] = naics_index.count(naics_prefix, min_revenue, max_revenue)
+        if counts['revenue'] < match_count:
+            messages.append(('info', f"Filtered to {counts['revenue']} transactions with similar revenue (${revenue*0.5:,.0f} - ${revenue*2:,.0f})"))
+    
+    # Filter by year if column exists - only the partitions from min_year onwards are read
+    positions = naics_index.positions(naics_prefix, min_revenue, max_revenue, min_year if has_year else None)
+    
+    # Back to dataset order so ties keep sorting the way they always have
+    positions = np.sort(positions)
+    filtered_df = store.rows(positions)
+    
+    # Year-specific rates travel with their rows through the sort below
+    if fx is not None:
+        filtered_df['usd_to_cad'] = store.conversion_rates(fx, usd_to_cad)[positions]
+    
+    if has_year:
+        counts['year'] = len(filtered_df)
+        if not filtered_df.empty:
+            messages.append(('info', f"Filtered to {len(filtered_df)} transactions from {min_year} onwards"))
+    
+    # Sort by year (most recent first) and revenue similarity
+    if not filtered_df.empty:
+        try:
+            sort_cols = []
+            if has_year:
+                sort_cols.append('year')
+            if has_revenue and revenue > 0:
+                filtered_df = filtered_df.assign(revenue_diff=abs(filtered_df['revenue'] - revenue))
+                sort_cols.append('revenue_diff')
+            
+            if sort_cols:
+                filtered_df = filtered_df.sort_values(sort_cols, ascending=[False] * len(sort_cols))
+                if 'revenue_diff' in filtered_df.columns:
+                    filtered_df = filtered_df.drop('revenue_diff', axis=1)
+        except Exception as e:
+            messages.append(('warning', f"Could not sort results: {e}"))
+    
+    # Limit results
+    filtered_df = filtered_df.head(max_results)
+    
+    # Convert to transaction format with CAD conversion
+    transactions = build_transaction_records(
+        filtered_df,
+        'naics',
+        amount_cols={"revenue": present('revenue'), "sde": present('sde'), "adj_ebitda": present('ebitda'), "price": present('price')},
+        multiple_cols={"rev_mult": present('rev_mult'), "sde_mult": present('sde_mult'), "ebitda_mult": present('ebitda_mult')},
+        usd_to_cad=filtered_df['usd_to_cad'].to_numpy() if fx is not None else usd_to_cad
+    )
+    counts['returned'] = len(transactions)
+    
+    if not transactions:
+        # Return sample data if no matches found
+        messages.append(('warning', "Could not convert transactions to proper format. Using sample data."))
+        return sample_result(revenue, usd_to_cad, naics_prefix, counts, messages, level_counts)
+    
+    messages.append(('success', f"✅ Successfully loaded {len(transactions)} comparable transactions from PeerComps dataset"))
+    return ComparablesResult(transactions, 'filter', naics_prefix, counts, None, messages, level_counts)
+
+def search_nearest_comparables(store, naics_clean, revenue, sde_margin, max_results, usd_to_cad, current_year, fx=None):
+    """
+    Rank every PeerComps transaction by similarity and keep the closest
+    
+    Similarity combines NAICS tree distance, log revenue, SDE margin and
+    transaction age (see NeighbourIndex), so there is no hard cut-off that can
+    leave the search empty.
+    
+    Returns:
+        ComparablesResult
+    """
+    messages = []
+    present = lambda name: name if store.has(name) else None
+    neighbours = store.neighbours
+    counts = {'ranked': len(neighbours)}
+    
+    point = neighbours.subject_point(revenue, sde_margin, current_year)
+    positions, _, shared_lengths = neighbours.nearest(naics_clean, point, max_results)
+    
+    if len(positions) == 0:
+        messages.append(('warning', "No PeerComps transactions have revenue to compare against. Using sample data."))
+        return sample_result(revenue, usd_to_cad, naics_clean, counts, messages)
+    
+    messages.append(('info', f"Ranked {len(neighbours):,} transactions by similarity (NAICS, revenue, SDE margin and age)"))
+    
+    # How closely the selected transactions match the subject's industry
+    match_levels = {}
+    levels = []
+    for length in NAICS_PREFIX_LENGTHS + [0]:
+        count = int((shared_lengths == length).sum())
+        if count:
+            match_levels[length] = count
+            levels.append(f"{count} at {length}-digit NAICS" if length else f"{count} outside the NAICS sector")
+    messages.append(('info', f"Closest {len(positions)}: " + ", ".join(levels)))
+    
+    transactions = build_transaction_records(
+        store.rows(positions),
+        'naics',
+        amount_cols={"revenue": present('revenue'), "sde": present('sde'), "adj_ebitda": present('ebitda'), "price": present('price')},
+        multiple_cols={"rev_mult": present('rev_mult'), "sde_mult": present('sde_mult'), "ebitda_mult": present('ebitda_mult')},
+        usd_to_cad=store.conversion_rates(fx, usd_to_cad)[positions] if fx is not None else usd_to_cad
+    )
+    counts['returned'] = len(transactions)
+    
+    messages.append(('success', f"✅ Successfully loaded {len(transactions)} comparable transactions from PeerComps dataset"))
+    return ComparablesResult(transactions, 'nearest', naics_clean, counts, match_levels, messages,
+                             store.naics_index.level_counts(naics_clean))
+
+# Transaction field each multiple is calculated from when the dataset leaves it blank
+MULTIPLE_BASES = {"rev_mult": "revenue", "sde_mult": "sde", "ebitda_mult": "adj_ebitda"}
+
+def build_transaction_records(df, naics_col, amount_cols, multiple_cols, usd_to_cad):
+    """
+    Convert matched PeerComps rows to transaction records using whole-column operations
+    
+    Args:
+        df: Matched PeerComps rows
+        naics_col: Name of the NAICS column
+        amount_cols: Mapping of output field to source column for USD amounts
+        multiple_cols: Mapping of output field to source column for multiples
+        usd_to_cad: USD to CAD exchange rate, or an array with one rate per row
+    
+    Returns:
+        List of transaction dicts, each with the 'usd_to_cad' rate applied;
+        missing values become 0
+    """
+    def numeric(col):
+        if col is None:
+            return np.zeros(len(df))
+        values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float)
+        return np.where(np.isfinite(values), values, 0.0)
+    
+    records = pd.DataFrame({"naics": df[naics_col].astype(str).to_numpy()})
+    
+    # Amounts are converted to CAD and truncated to whole dollars
+    rates = np.broadcast_to(np.asarray(usd_to_cad, dtype=float), (len(df),))
+    for field, col in amount_cols.items():
+        records[field] = np.trunc(numeric(col) * rates).astype(np.int64)
+    
+    for field, col in multiple_cols.items():
+        records[field] = np.round(numeric(col), 2)
+    
+    # Calculate missing multiples if we have the data
+    price = records["price"].to_numpy()
+    for mult_field, base_field in MULTIPLE_BASES.items():
+        base = records[base_field].to_numpy()
+        missing = (price > 0) & (records[mult_field].to_numpy() == 0) & (base > 0)
+        records.loc[missing, mult_field] = np.round(price[missing] / base[missing], 2)
+    
+    records["usd_to_cad"] = np.round(rates, 4)
+    return records.to_dict('records')
+
+def generate_sample_comparables(revenue, usd_to_cad=1.40):
+    """Generate sample comparable transactions if dataset is unavailable"""
+    base_revenue = revenue if revenue > 0 else 500000
+    transactions = []
+    
+    for i in range(16):
+        rev = base_revenue * (0.8 + i * 0.05)
+        sde = rev * (0.15 + i * 0.01)
+        ebitda = sde * 0.6
+        price = rev * (0.73 + i * 0.01)
+        
+        trans = {
+            "naics": "311999",
+            "revenue": int(rev),
+            "sde": int(sde),
+            "adj_ebitda": int(ebitda),
+            "price": int(price),
+            "rev_mult": round(price / rev, 2),
+            "sde_mult": round(price / sde, 2),
+            "ebitda_mult": round(price / ebitda, 2),
+            "usd_to_cad": usd_to_cad
+        }
+        transactions.append(trans)
+    
+    return transactions
+
+
+def main():
+    """Command line entry point: query comparables or ingest a delta workbook"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="PeerComps comparables engine")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    query = commands.add_parser('query', help="Find comparable transactions")
+    query.add_argument('naics', help="NAICS code of the business")
+    query.add_argument('revenue', type=float, help="Revenue of the business")
+    query.add_argument('--sde', type=float, default=None, help="SDE of the business (nearest method)")
+    query.add_argument('--method', choices=['nearest', 'filter'], default='nearest')
+    query.add_argument('--year-range', type=int, default=5, help="Years back to look (filter method)")
+    query.add_argument('--max-results', type=int, default=20)
+    query.add_argument('--min-matches', type=int, default=1, help="Fewest transactions for a NAICS level (filter method)")
+    query.add_argument('--usd-to-cad', type=float, default=1.40, help="Rate for transactions without a year-specific rate")
+    query.add_argument('--fx-rates', default=FX_RATES_PATH, help="CSV of USD to CAD rates by year (and month)")
+    query.add_argument('--json', action='store_true', help="Print the result as JSON")
+    
+    ingest = commands.add_parser('ingest', help="Append a delta workbook to the dataset")
+    ingest.add_argument('delta', help="Path to the delta workbook (.xlsx or .csv)")
+    
+    args = parser.parse_args()
+    
+    if args.command == 'ingest':
+        try:
+            result = ingest_peercomps_delta(args.delta)
+        except (ValueError, RuntimeError) as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        if result['already_ingested']:
+            print("This delta workbook has already been ingested.")
+        else:
+            print(f"Added {result['added']:,} transactions ({result['duplicates']:,} duplicates skipped)")
+        return
+    
+    result = find_comparables(
+        read_peercomps_store(), args.naics, args.revenue,
+        year_range=args.year_range,
+        max_results=args.max_results,
+        usd_to_cad=args.usd_to_cad,
+        sde=args.sde,
+        method=args.method,
+        min_matches=args.min_matches,
+        fx=read_fx_rates(args.fx_rates)
+    )
+    
+    if args.json:
+        print(json.dumps({
+            'method': result.method,
+            'naics_prefix': result.naics_prefix,
+            'counts': result.counts,
+            'match_levels': result.match_levels,
+            'level_counts': result.level_counts,
+            'messages': [{'level': level, 'text': text} for level, text in result.messages],
+            'transactions': result.transactions
+        }, indent=2))
+    else:
+        for level, text in result.messages:
+            print(f"[{level}] {text}")
+        print(pd.DataFrame(result.transactions).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
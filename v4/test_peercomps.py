@@ -0,0 +1,34 @@
+"""
+PeerComps Engine Tests
+Run with: python -m pytest v4
+"""
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from peercomps import dedupe_column_names, read_canonical_peercomps
+
+
+def write_workbook(path, header, rows):
+    """Save a one-sheet workbook with the given header and rows"""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def test_repeated_headers_are_deduplicated_like_pandas(tmp_path):
+    path = str(tmp_path / 'repeated.xlsx')
+    header = ['NAICS Code', 'Year', 'Revenue', 'Sale Price', 'Revenue', 'Revenue.1', 'Revenue']
+    write_workbook(path, header, [[311999, 2023, 500000, 900000, 1, 2, 3], [541611, 2024, 750000, 1200000, 4, 5, 6]])
+    
+    assert dedupe_column_names(header) == list(pd.read_excel(path).columns)
+    
+    df, source_columns, schema = read_canonical_peercomps(path)
+    assert source_columns == ['NAICS Code', 'Year', 'Revenue', 'Sale Price', 'Revenue.2', 'Revenue.1', 'Revenue.3']
+    assert schema['revenue'] == 'Revenue'
+    np.testing.assert_array_equal(df['revenue'], [500000, 750000])
+    np.testing.assert_array_equal(df['price'], [900000, 1200000])
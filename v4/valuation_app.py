@@ -5,6 +5,13 @@ from datetime import datetime
 import io
 from rapidfuzz import fuzz, process
 import os
+import tempfile
+import hashlib
+from peercomps import (
+    PeerCompsLoader, ComparablesCache, find_comparables, find_industry_multiples,
+    comparable_multiple, ingest_peercomps_delta, read_fx_rates, file_sha256, FX_RATES_PATH
+)
+from learned_mappings import LearnedMappings
 
 # Set page config
 st.set_page_config(page_title="Business Valuation Report Generator", layout="wide")
@@ -239,250 +246,130 @@ NAICS_SUBCODES = {
     }
 }
 
-# Load PeerComps dataset
-@st.cache_data
+@st.cache_resource
+def get_peercomps_loader():
+    """Process-wide PeerComps loader, shared by every session"""
+    return PeerCompsLoader()
+
 def load_peercomps():
-    """Load the PeerComps dataset"""
+    """
+    Current PeerComps store, reopened when the workbook changes or a delta is ingested
+    
+    One PeerCompsStore is loaded per server process and handed to every session
+    and rerun as-is - nothing is pickled or copied per caller. Never waits for
+    a background load: until the first load finishes this is None, and while a
+    reload runs it is the previous store.
+    """
+    loader = get_peercomps_loader()
+    loader.ensure_started()
+    return loader.store
+
+# Sidebar label of each part of PeerCompsStore.memory_report()
+MEMORY_REPORT_PARTS = {
+    'columns': "Columns",
+    'naics_index': "NAICS index",
+    'neighbour_points': "Neighbour points",
+    'neighbour_trees': "Neighbour KD-trees",
+    'multiple_stats': "Multiple statistics",
+    'total': "Total"
+}
+
+# Seconds between redraws of the PeerComps load progress
+PEERCOMPS_PROGRESS_INTERVAL = 0.5
+
+@st.fragment(run_every=PEERCOMPS_PROGRESS_INTERVAL)
+def show_peercomps_progress():
+    """
+    Progress bar of a background PeerComps load
+    
+    Only this fragment is redrawn while the dataset loads, so the rest of the
+    page, sidebar included, renders straight away and stays responsive. When
+    the load finishes the whole app reruns once to pick up the dataset.
+    """
+    loader = get_peercomps_loader()
+    if loader.status != 'loading':
+        st.rerun()
+    
+    if loader.progress is None:
+        st.progress(0.0, text=f"Loading PeerComps dataset... {loader.rows_read:,} rows")
+    else:
+        st.progress(loader.progress, text=f"Loading PeerComps dataset... {loader.rows_read:,} of {loader.total_rows:,} rows")
+
+@st.cache_resource
+def get_comparables_cache():
+    """Process-wide comparables query cache"""
+    return ComparablesCache()
+
+@st.cache_resource(show_spinner=False)
+def read_fx_table(version):
+    """Parse the FX rate table once per file version"""
+    return read_fx_rates(FX_RATES_PATH)
+
+def get_fx_rates():
+    """
+    Local USD to CAD rate table, reloaded when the file changes
+    
+    Returns:
+        FxRates, or None if the table is missing or cannot be read
+    """
+    if not os.path.exists(FX_RATES_PATH):
+        return None
     try:
-        if os.path.exists('PeerComps_dataset.xlsx'):
-            df = pd.read_excel('PeerComps_dataset.xlsx')
-            # Clean column names - strip whitespace and standardize
-            df.columns = df.columns.str.strip()
-            
-            # Remove any completely empty rows
-            df = df.dropna(how='all')
-            
-            # Remove header rows that might be in the data
-            # (sometimes Excel files have multiple header rows)
-            if len(df) > 0:
-                # Check if first row looks like a header
-                first_row = df.iloc[0]
-                if any(str(val).lower() in ['naics', 'revenue', 'price', 'year'] for val in first_row):
-                    df = df.iloc[1:]
-                    df = df.reset_index(drop=True)
-            
-            # Print column names for debugging
-            print(f"PeerComps columns: {df.columns.tolist()}")
-            print(f"PeerComps shape: {df.shape}")
-            
-            return df
-        else:
-            st.warning("PeerComps_dataset.xlsx not found in current directory. Using sample data.")
-            return None
+        return read_fx_table(file_sha256(FX_RATES_PATH))
     except Exception as e:
-        st.error(f"Error loading PeerComps dataset: {e}")
-        import traceback
-        print(traceback.format_exc())
+        print(f"Could not read FX rate table: {e}")
         return None
 
-def find_column(df, search_terms, exact_first=True):
+def lookup_industry_multiples(naics_code, revenue):
     """
-    Robustly find a column in the dataframe
+    Industry multiple statistics from the precomputed PeerComps table
     
     Args:
-        df: DataFrame to search
-        search_terms: List of terms to search for (in order of preference)
-        exact_first: If True, try exact matches first
+        naics_code: NAICS code (text descriptions are ignored)
+        revenue: Company's revenue in USD, to pick the revenue band
     
     Returns:
-        Column name if found, None otherwise
+        Dict from MultipleStats.lookup(), or {} if the dataset is unavailable
     """
-    if df is None or df.empty:
-        return None
-    
-    # Normalize column names
-    cols_lower = {col: col.lower().strip() for col in df.columns}
-    
-    # Try exact matches first
-    if exact_first:
-        for term in search_terms:
-            term_lower = term.lower().strip()
-            for col, col_lower in cols_lower.items():
-                if col_lower == term_lower:
-                    return col
-    
-    # Try partial matches
-    for term in search_terms:
-        term_lower = term.lower().strip()
-        for col, col_lower in cols_lower.items():
-            if term_lower in col_lower:
-                return col
-    
-    return None
+    return find_industry_multiples(load_peercomps(), naics_code, revenue)
 
-def find_comparable_transactions(naics_code, revenue, year_range=5, max_results=20, usd_to_cad=1.40):
+def find_comparable_transactions(naics_code, revenue, year_range=5, max_results=20, usd_to_cad=1.40,
+                                 sde=None, method='nearest', min_matches=1, fx=None):
     """
     Find comparable transactions from PeerComps dataset
     
+    Runs peercomps.find_comparables() against the shared store and query
+    cache and shows its diagnostics in the app.
+    
     Args:
         naics_code: NAICS code to search for
         revenue: Company's revenue for filtering
-        year_range: How many years back to look
+        year_range: How many years back to look ('filter' method only)
         max_results: Maximum number of comparables to return
         usd_to_cad: USD to CAD exchange rate
+        sde: Company's SDE, used for the SDE margin ('nearest' method only)
+        method: 'nearest' ranks every transaction by similarity; 'filter' narrows
+            by NAICS prefix, revenue window and year cut-off
+        min_matches: Fewest transactions a NAICS prefix needs before the filter
+            method searches at that level
+        fx: Optional FxRates to convert each transaction at its year's rate
     """
-    df = load_peercomps()
-    
-    if df is None or df.empty:
-        # Return sample data if dataset not available
-        return generate_sample_comparables(revenue, usd_to_cad)
-    
-    # Clean the dataframe
-    df = df.copy()
-    
-    # Find required columns using robust search
-    naics_col = find_column(df, ['NAICS Code', 'NAICS', 'naics_code', 'Industry Code'])
-    year_col = find_column(df, ['Year', 'year', 'Transaction Year', 'Sale Year'])
-    revenue_col = find_column(df, ['Revenue', 'revenue', 'Sales', 'Annual Revenue'])
-    price_col = find_column(df, ['Sale Price', 'Price', 'price', 'Transaction Price', 'Purchase Price'])
-    sde_col = find_column(df, ['SDE', 'sde', 'Seller Discretionary Earnings'])
-    ebitda_col = find_column(df, ['EBITDA', 'ebitda', 'Adj EBITDA', 'Adjusted EBITDA'])
-    
-    # Find multiple columns
-    rev_mult_col = find_column(df, ['P/R', 'p/r', 'Revenue Multiple', 'Price/Revenue'])
-    sde_mult_col = find_column(df, ['P/SDE', 'p/sde', 'SDE Multiple', 'Price/SDE'])
-    ebitda_mult_col = find_column(df, ['P/EBITDA', 'p/ebitda', 'EBITDA Multiple', 'Price/EBITDA'])
-    
-    # Debug info
-    if naics_col is None:
-        available_cols = ", ".join(df.columns.tolist()[:10])
-        st.warning(f"Could not find NAICS column. Available columns: {available_cols}... Using sample data.")
-        return generate_sample_comparables(revenue, usd_to_cad)
-    
-    # Extract numeric NAICS code (remove any text descriptions)
-    naics_clean = ''.join(filter(str.isdigit, str(naics_code)))
-    
-    # Current year for filtering
-    current_year = datetime.now().year
-    min_year = current_year - year_range
-    
-    # Filter by NAICS code (match first 3-6 digits depending on specificity)
-    naics_lengths = [6, 5, 4, 3, 2]  # Try matching from most to least specific
-    filtered_df = pd.DataFrame()
-    
-    for length in naics_lengths:
-        if len(naics_clean) >= length:
-            naics_prefix = naics_clean[:length]
-            try:
-                # Convert NAICS column to string and extract digits only
-                df['naics_clean'] = df[naics_col].astype(str).apply(lambda x: ''.join(filter(str.isdigit, x)))
-                temp_df = df[df['naics_clean'].str[:length] == naics_prefix]
-                if not temp_df.empty:
-                    filtered_df = temp_df
-                    st.info(f"Found {len(filtered_df)} transactions matching NAICS prefix: {naics_prefix} ({length} digits)")
-                    break
-            except Exception as e:
-                continue
-    
-    if filtered_df.empty:
-        st.warning(f"No NAICS matches found for {naics_code}. Using sample data.")
-        return generate_sample_comparables(revenue, usd_to_cad)
-    
-    # Filter by year if column exists
-    if year_col and year_col in filtered_df.columns:
-        try:
-            filtered_df[year_col] = pd.to_numeric(filtered_df[year_col], errors='coerce')
-            filtered_df = filtered_df[filtered_df[year_col] >= min_year]
-            if not filtered_df.empty:
-                st.info(f"Filtered to {len(filtered_df)} transactions from {min_year} onwards")
-        except Exception as e:
-            st.warning(f"Could not filter by year: {e}")
-    
-    # Filter by similar revenue (within 50% to 200% of target)
-    if revenue_col and revenue_col in filtered_df.columns and revenue > 0:
-        try:
-            filtered_df[revenue_col] = pd.to_numeric(filtered_df[revenue_col], errors='coerce')
-            before_count = len(filtered_df)
-            filtered_df = filtered_df[
-                (filtered_df[revenue_col] >= revenue * 0.5) & 
-                (filtered_df[revenue_col] <= revenue * 2.0)
-            ]
-            if len(filtered_df) < before_count:
-                st.info(f"Filtered to {len(filtered_df)} transactions with similar revenue (${revenue*0.5:,.0f} - ${revenue*2:,.0f})")
-        except Exception as e:
-            st.warning(f"Could not filter by revenue: {e}")
-    
-    # Sort by year (most recent first) and revenue similarity
-    if not filtered_df.empty:
-        try:
-            sort_cols = []
-            if year_col and year_col in filtered_df.columns:
-                sort_cols.append(year_col)
-            if revenue_col and revenue_col in filtered_df.columns and revenue > 0:
-                filtered_df['revenue_diff'] = abs(filtered_df[revenue_col] - revenue)
-                sort_cols.append('revenue_diff')
-            
-            if sort_cols:
-                filtered_df = filtered_df.sort_values(sort_cols, ascending=[False] * len(sort_cols))
-                if 'revenue_diff' in filtered_df.columns:
-                    filtered_df = filtered_df.drop('revenue_diff', axis=1)
-        except Exception as e:
-            st.warning(f"Could not sort results: {e}")
-    
-    # Limit results
-    filtered_df = filtered_df.head(max_results)
-    
-    # Convert to transaction format with CAD conversion
-    transactions = []
-    
-    for _, row in filtered_df.iterrows():
-        try:
-            trans = {
-                "naics": str(row.get(naics_col, '')) if naics_col else '',
-                "revenue": int(float(row.get(revenue_col, 0)) * usd_to_cad) if revenue_col and pd.notna(row.get(revenue_col)) else 0,
-                "sde": int(float(row.get(sde_col, 0)) * usd_to_cad) if sde_col and pd.notna(row.get(sde_col)) else 0,
-                "adj_ebitda": int(float(row.get(ebitda_col, 0)) * usd_to_cad) if ebitda_col and pd.notna(row.get(ebitda_col)) else 0,
-                "price": int(float(row.get(price_col, 0)) * usd_to_cad) if price_col and pd.notna(row.get(price_col)) else 0,
-                "rev_mult": round(float(row.get(rev_mult_col, 0)), 2) if rev_mult_col and pd.notna(row.get(rev_mult_col)) else 0,
-                "sde_mult": round(float(row.get(sde_mult_col, 0)), 2) if sde_mult_col and pd.notna(row.get(sde_mult_col)) else 0,
-                "ebitda_mult": round(float(row.get(ebitda_mult_col, 0)), 2) if ebitda_mult_col and pd.notna(row.get(ebitda_mult_col)) else 0
-            }
-            
-            # Calculate missing multiples if we have the data
-            if trans["price"] > 0:
-                if trans["rev_mult"] == 0 and trans["revenue"] > 0:
-                    trans["rev_mult"] = round(trans["price"] / trans["revenue"], 2)
-                if trans["sde_mult"] == 0 and trans["sde"] > 0:
-                    trans["sde_mult"] = round(trans["price"] / trans["sde"], 2)
-                if trans["ebitda_mult"] == 0 and trans["adj_ebitda"] > 0:
-                    trans["ebitda_mult"] = round(trans["price"] / trans["adj_ebitda"], 2)
-            
-            transactions.append(trans)
-        except Exception as e:
-            continue
-    
-    if not transactions:
-        # Return sample data if no matches found
-        st.warning("Could not convert transactions to proper format. Using sample data.")
-        return generate_sample_comparables(revenue, usd_to_cad)
+    result = find_comparables(
+        load_peercomps(), naics_code, revenue,
+        year_range=year_range,
+        max_results=max_results,
+        usd_to_cad=usd_to_cad,
+        sde=sde,
+        method=method,
+        cache=get_comparables_cache(),
+        min_matches=min_matches,
+        fx=fx
+    )
     
-    st.success(f"✅ Successfully loaded {len(transactions)} comparable transactions from PeerComps dataset")
-    return transactions
-
-def generate_sample_comparables(revenue, usd_to_cad=1.40):
-    """Generate sample comparable transactions if dataset is unavailable"""
-    base_revenue = revenue if revenue > 0 else 500000
-    transactions = []
-    
-    for i in range(16):
-        rev = base_revenue * (0.8 + i * 0.05)
-        sde = rev * (0.15 + i * 0.01)
-        ebitda = sde * 0.6
-        price = rev * (0.73 + i * 0.01)
-        
-        trans = {
-            "naics": "311999",
-            "revenue": int(rev),
-            "sde": int(sde),
-            "adj_ebitda": int(ebitda),
-            "price": int(price),
-            "rev_mult": round(price / rev, 2),
-            "sde_mult": round(price / sde, 2),
-            "ebitda_mult": round(price / ebitda, 2)
-        }
-        transactions.append(trans)
+    for level, message in result.messages:
+        getattr(st, level)(message)
     
-    return transactions
+    return result.transactions
 
 # Required financial row items
 REQUIRED_FINANCIAL_ITEMS = [
@@ -500,6 +387,259 @@ REQUIRED_NORMALIZATION_ITEMS = [
     "Replacement Manager Salary"
 ]
 
+# Table column filled by each required item
+FINANCIAL_COLUMNS = {
+    "Total Revenue": 'Revenue',
+    "Total Cost of Goods Sold": 'Cost of Goods',
+    "Total Operating Expenses": 'Total Expenses',
+    "Other Income": 'Other Income'
+}
+
+NORMALIZATION_COLUMNS = {
+    "Amortization": 'Amortization',
+    "Interest on Capital Lease/Equipment": 'Interest (Capital Lease)',
+    "Owner/Management Salary": 'Management Salary',
+    "Discretionary Expenses": 'Discretionary Expense',
+    "Replacement Manager Salary": 'Manager Salary'
+}
+
+# Fuzzy scores at or below this leave a required item unmapped
+FUZZY_MATCH_THRESHOLD = 60
+
+# Charts of accounts at least this long are scored on every CPU core
+FUZZY_PARALLEL_ITEMS = 500
+
+# Options passed to the parser of each upload type
+UPLOAD_PARSER_OPTIONS = {'csv': {}, 'xlsx': {'sheet_name': 0}}
+
+def upload_sha256(uploaded_file):
+    """SHA-256 of an uploaded file's content"""
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def parse_upload(file_sha256, kind, options, _content):
+    """
+    Parse an uploaded financial data file
+    
+    Cached on the content hash and parser options for every session, so a
+    rerun reuses the parsed frame and identical files are parsed once.
+    
+    Args:
+        file_sha256: Content hash of the uploaded file
+        kind: 'csv' or 'xlsx'
+        options: Tuple of (name, value) parser options
+        _content: The file's bytes
+    
+    Returns:
+        DataFrame of the file's first sheet
+    """
+    reader = pd.read_csv if kind == 'csv' else pd.read_excel
+    return reader(io.BytesIO(_content), **dict(options))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def fuzzy_match_scores(file_sha256, required_items, scored_positions, _available_items):
+    """
+    Score required items against available items in one batch
+    
+    Cached on the uploaded file's content hash (the available items come from
+    that file) and the items scored, so the mapping widgets re-render without
+    rescoring.
+    
+    Args:
+        file_sha256: Content hash of the uploaded file
+        required_items: Tuple of required item names
+        scored_positions: Tuple of positions in _available_items to score
+        _available_items: Row or column names found in the upload
+    
+    Returns:
+        Matrix of token_sort_ratio scores, one row per required item and one
+        column per scored position
+    """
+    workers = -1 if len(scored_positions) >= FUZZY_PARALLEL_ITEMS else 1
+    return process.cdist(
+        list(required_items), [str(_available_items[i]) for i in scored_positions],
+        scorer=fuzz.token_sort_ratio, workers=workers
+    )
+
+@st.cache_resource
+def get_learned_mappings():
+    """Process-wide store of mappings accepted for earlier uploads"""
+    return LearnedMappings()
+
+def suggest_mappings(file_sha256, available_items, required_items):
+    """
+    Suggested available item for each required item
+    
+    An upload whose label set was mapped before gets that mapping back by exact
+    lookup. Otherwise labels accepted before map to their learned item and
+    only the labels not seen before are fuzzy-scored for the remaining items.
+    
+    Args:
+        file_sha256: Content hash of the uploaded file
+        available_items: Row or column names found in the upload
+        required_items: Tuple of required item names
+    
+    Returns:
+        Tuple of (dict of required item to the position of its suggested
+        available item, or None; True if the whole mapping was learned)
+    """
+    learned_mappings = get_learned_mappings()
+    position_of = {}
+    for position, label in enumerate(available_items):
+        position_of.setdefault(label, position)
+    
+    try:
+        learned = learned_mappings.lookup_label_set(available_items)
+        learned_labels = learned_mappings.lookup_labels(available_items)
+    except Exception as e:
+        print(f"Could not read learned mappings: {e}")
+        learned, learned_labels = {}, {}
+    
+    if all(item in learned for item in required_items):
+        return {item: position_of.get(learned[item]) for item in required_items}, True
+    
+    suggestions = {}
+    for label, item in learned_labels.items():
+        if item in required_items and item not in suggestions:
+            suggestions[item] = position_of[label]
+    
+    remaining = tuple(item for item in required_items if item not in suggestions)
+    unseen = tuple(i for i, label in enumerate(available_items) if label not in learned_labels)
+    if remaining and unseen:
+        scores = fuzzy_match_scores(file_sha256, remaining, unseen, available_items)
+        for item, row in zip(remaining, scores):
+            best = int(row.argmax())
+            suggestions[item] = unseen[best] if row[best] > FUZZY_MATCH_THRESHOLD else None
+    return suggestions, False
+
+def parse_amounts(values):
+    """
+    Convert a column of statement amounts to floats in one vectorized pass
+    
+    Thousands separators, dollar signs and spaces are ignored and amounts in
+    parentheses are negative. Anything else that is not a number becomes NaN.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float)
+    
+    text = values.astype(str).str.strip()
+    negative = text.str.fullmatch(r'\(.*\)')
+    amounts = pd.to_numeric(text.str.replace(r'[,$()\s]', '', regex=True), errors='coerce')
+    return amounts.where(~negative, -amounts)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def reshape_upload(file_sha256, options, _df_uploaded):
+    """
+    Normalize an uploaded statement to a long (item, year, value) frame
+    
+    Two layouts are detected. With a 'Year' column each row is a year and the
+    other columns are line items; otherwise the first column names the line
+    items and every other column is a year. Either way the frame is melted in
+    one operation, so the work does not grow with Python loops over items or
+    periods. Years are reduced to their four digits where they have them
+    (e.g. 'FY2023' or 2023.0 become '2023') and periods with no numeric
+    values, such as notes or empty columns, are dropped.
+    
+    Args:
+        file_sha256: Content hash of the uploaded file
+        options: Tuple of (name, value) parser options used for the file
+        _df_uploaded: The parsed upload
+    
+    Returns:
+        Tuple of (long DataFrame with 'item', 'year' and 'value' columns,
+        list of line item labels in file order)
+    
+    Raises:
+        ValueError: If the file has neither a 'Year' column nor a label column
+    """
+    df = _df_uploaded
+    year_col = next((col for col in df.columns if str(col).strip().lower() == 'year'), None)
+    
+    if year_col is not None:
+        # Years as rows, line items as columns
+        available_items = [col for col in df.columns if str(col).strip().lower() not in ['year', 'item', 'category']]
+        long_df = df.melt(id_vars=[year_col], value_vars=available_items, var_name='item', value_name='value')
+        long_df = long_df.rename(columns={year_col: 'year'})
+    elif len(df.columns) > 1:
+        # Line items as rows, years as columns
+        label_col = df.columns[0]
+        available_items = df[label_col].tolist()
+        long_df = df.melt(id_vars=[label_col], var_name='year', value_name='value')
+        long_df = long_df.rename(columns={label_col: 'item'})
+    else:
+        raise ValueError("Could not determine data structure. Please ensure your file has year columns or a description column.")
+    
+    long_df = long_df[long_df['year'].notna() & long_df['item'].notna()]
+    years = long_df['year'].astype(str).str.strip()
+    long_df = long_df.assign(
+        year=years.str.extract(r'((?:19|20)\d{2})', expand=False).fillna(years),
+        value=parse_amounts(long_df['value'])
+    )
+    
+    # Drop periods without numbers; the first row of a repeated label wins
+    has_values = long_df['value'].notna().groupby(long_df['year']).transform('any')
+    long_df = long_df[has_values].drop_duplicates(['item', 'year'], keep='first')
+    return long_df.reset_index(drop=True), available_items
+
+def build_statement_tables(long_df, mapping):
+    """
+    Build the income statement and normalization tables from a long upload
+    
+    The long frame is pivoted once to a year-by-item table and every mapped
+    column is taken from it together; unmapped items are filled with 0. A
+    projection year is added from the average revenue growth, and the most
+    recent years get the weighting.
+    
+    Args:
+        long_df: Long (item, year, value) frame from reshape_upload
+        mapping: Dict of required item to its uploaded label, or None
+    
+    Returns:
+        Tuple of (financial_data, normalization_data) DataFrames
+    
+    Raises:
+        ValueError: If the upload has no yearly values
+    """
+    if long_df.empty:
+        raise ValueError("No yearly values found in the uploaded file.")
+    
+    # Calendar years in ascending order; other period labels in file order
+    years = list(pd.unique(long_df['year']))
+    if all(year.isdigit() for year in years):
+        years = sorted(years, key=int)
+    
+    wide = long_df.pivot(index='year', columns='item', values='value')
+    columns = {**FINANCIAL_COLUMNS, **NORMALIZATION_COLUMNS}
+    mapped = {column: mapping[item] for item, column in columns.items() if mapping.get(item) is not None}
+    table = wide.reindex(index=years, columns=list(mapped.values()))
+    table.columns = list(mapped)
+    table = table.reindex(columns=list(columns.values())).fillna(0)
+    
+    # Calculate projection year
+    revenue = table['Revenue'][table['Revenue'] != 0]
+    if len(revenue) >= 2:
+        avg_growth = revenue.pct_change().iloc[1:].mean()
+        last_year = int(years[-1]) if years[-1].isdigit() else 2026
+        
+        projection = table.iloc[-1].copy()
+        projection['Revenue'] = revenue.iloc[-1] * (1 + avg_growth)
+        projection[['Cost of Goods', 'Total Expenses']] *= 1 + avg_growth
+        projection['Other Income'] = 0
+        table.loc[str(last_year + 1)] = projection
+    
+    # Create weighting (most recent years get more weight)
+    total_years = len(table)
+    if total_years <= 3:
+        weightings = [100 // total_years] * total_years
+    else:
+        # Last year gets most weight
+        weightings = [0] * (total_years - 3) + [20, 30, 50]
+    
+    table = table.rename_axis('Year').reset_index()
+    financial_data = table[['Year'] + list(FINANCIAL_COLUMNS.values())]
+    normalization_data = table[['Year'] + list(NORMALIZATION_COLUMNS.values())].assign(**{'Year Weighting (%)': weightings})
+    return financial_data, normalization_data
+
 # Helper function to convert score to text answer
 def score_to_answer(score, question_type):
     """Convert numeric score (1-5) to text answer"""
@@ -540,6 +680,9 @@ if 'uploaded_data' not in st.session_state:
 if 'row_mapping' not in st.session_state:
     st.session_state.row_mapping = {}
 
+# Start loading PeerComps in the background; only the Export tab needs it
+get_peercomps_loader().ensure_started()
+
 # Title
 st.title("🏢 Business Valuation Report Generator")
 st.markdown("Generate comprehensive valuation report data in JSON format")
@@ -621,11 +764,11 @@ with tab2:
     
     if uploaded_file is not None:
         try:
-            # Read file
-            if uploaded_file.name.endswith('.csv'):
-                df_uploaded = pd.read_csv(uploaded_file)
-            else:
-                df_uploaded = pd.read_excel(uploaded_file)
+            # Read file (parsed once per content and parser options)
+            file_hash = upload_sha256(uploaded_file)
+            kind = 'csv' if uploaded_file.name.endswith('.csv') else 'xlsx'
+            parser_options = tuple(UPLOAD_PARSER_OPTIONS[kind].items())
+            df_uploaded = parse_upload(file_hash, kind, parser_options, uploaded_file.getvalue())
             
             st.session_state.uploaded_data = df_uploaded
             st.success("✅ File uploaded successfully!")
@@ -640,19 +783,21 @@ with tab2:
             st.subheader("🔗 Map Your Data to Required Fields")
             st.markdown("*We've attempted to automatically match your columns. Please verify and adjust as needed.*")
             
-            # Get all potential row/column names from uploaded data
-            if 'Year' in df_uploaded.columns or 'year' in df_uploaded.columns:
-                # Data is in columns (years as columns)
-                available_items = [col for col in df_uploaded.columns if col.lower() not in ['year', 'item', 'category']]
-                is_transposed = False
-            else:
-                # Data is in rows (years as rows)
-                if len(df_uploaded.columns) > 1:
-                    available_items = df_uploaded.iloc[:, 0].tolist()
-                    is_transposed = True
-                else:
-                    st.error("Could not determine data structure. Please ensure your file has year columns or a description column.")
-                    available_items = []
+            # Line items and their values in long (item, year) form, for either layout
+            try:
+                long_data, available_items = reshape_upload(file_hash, parser_options, df_uploaded)
+            except ValueError as e:
+                st.error(str(e))
+                long_data, available_items = pd.DataFrame(columns=['item', 'year', 'value']), []
+            
+            # Suggested mapping: learned from earlier uploads, fuzzy matched otherwise
+            suggestions = {}
+            if available_items:
+                suggestions, fully_learned = suggest_mappings(
+                    file_hash, available_items, tuple(REQUIRED_FINANCIAL_ITEMS + REQUIRED_NORMALIZATION_ITEMS)
+                )
+                if fully_learned:
+                    st.info("🧠 Mapped from a previous upload with the same labels")
             
             # Create mapping interface for financial items
             st.markdown("**Income Statement Items:**")
@@ -667,10 +812,9 @@ with tab2:
                 with col2:
                     # Try fuzzy matching
                     if available_items:
-                        matches = process.extract(required_item, available_items, scorer=fuzz.token_sort_ratio, limit=3)
-                        best_match = matches[0][0] if matches and matches[0][1] > 60 else None
-                        
-                        default_index = available_items.index(best_match) if best_match in available_items else 0
+                        suggested = suggestions.get(required_item)
+                        best_match = available_items[suggested] if suggested is not None else None
+                        default_index = suggested or 0
                     else:
                         default_index = 0
                     
@@ -702,10 +846,9 @@ with tab2:
                 with col2:
                     # Try fuzzy matching
                     if available_items:
-                        matches = process.extract(required_item, available_items, scorer=fuzz.token_sort_ratio, limit=3)
-                        best_match = matches[0][0] if matches and matches[0][1] > 60 else None
-                        
-                        default_index = available_items.index(best_match) if best_match in available_items else 0
+                        suggested = suggestions.get(required_item)
+                        best_match = available_items[suggested] if suggested is not None else None
+                        default_index = suggested or 0
                     else:
                         default_index = 0
                     
@@ -726,123 +869,25 @@ with tab2:
             
             # Process button
             if st.button("✨ Process Uploaded Data", type="primary", use_container_width=True):
-                # Extract years and create new dataframes
-                if is_transposed:
-                    # Years are in rows
-                    year_col_idx = next((i for i, col in enumerate(df_uploaded.columns) if 'year' in col.lower()), 0)
-                    years = df_uploaded.iloc[:, year_col_idx].tolist()
-                    
-                    # Extract financial data
-                    revenue_vals = []
-                    cogs_vals = []
-                    expenses_vals = []
-                    other_income_vals = []
-                    
-                    for item, mapped in financial_mapping.items():
-                        if mapped:
-                            row_idx = available_items.index(mapped)
-                            values = df_uploaded.iloc[row_idx, 1:].tolist()
-                        else:
-                            values = [0] * len(years)
-                        
-                        if "Revenue" in item:
-                            revenue_vals = values
-                        elif "Cost" in item:
-                            cogs_vals = values
-                        elif "Expenses" in item:
-                            expenses_vals = values
-                        elif "Other Income" in item:
-                            other_income_vals = values
-                else:
-                    # Years are in columns
-                    year_cols = [col for col in df_uploaded.columns if str(col).isdigit() or 'year' in str(col).lower()]
-                    years = year_cols
-                    
-                    # This structure needs more complex handling - simplified for now
-                    st.error("Column-based year format not fully implemented. Please transpose your data so years are rows.")
-                    revenue_vals = [0] * len(years)
-                    cogs_vals = [0] * len(years)
-                    expenses_vals = [0] * len(years)
-                    other_income_vals = [0] * len(years)
+                # Remember the accepted mapping for the next upload with these labels
+                try:
+                    get_learned_mappings().save(available_items, {**financial_mapping, **normalization_mapping})
+                except Exception as e:
+                    print(f"Could not save learned mappings: {e}")
                 
-                # Calculate projection year
-                if len(years) >= 2:
-                    # Calculate average growth rate
-                    numeric_revenues = [float(x) for x in revenue_vals if str(x).replace('.', '').replace('-', '').isdigit()]
-                    if len(numeric_revenues) >= 2:
-                        growth_rates = [(numeric_revenues[i] - numeric_revenues[i-1]) / numeric_revenues[i-1] 
-                                      for i in range(1, len(numeric_revenues))]
-                        avg_growth = sum(growth_rates) / len(growth_rates)
-                        
-                        # Project next year
-                        last_year = int(years[-1]) if str(years[-1]).isdigit() else 2026
-                        proj_year = last_year + 1
-                        
-                        proj_revenue = numeric_revenues[-1] * (1 + avg_growth)
-                        proj_cogs = (float(cogs_vals[-1]) * (1 + avg_growth) if cogs_vals[-1] else 0)
-                        proj_expenses = (float(expenses_vals[-1]) * (1 + avg_growth) if expenses_vals[-1] else 0)
-                        proj_other = 0
-                        
-                        years.append(str(proj_year))
-                        revenue_vals.append(proj_revenue)
-                        cogs_vals.append(proj_cogs)
-                        expenses_vals.append(proj_expenses)
-                        other_income_vals.append(proj_other)
-                
-                # Create new dataframes
-                st.session_state.financial_data = pd.DataFrame({
-                    'Year': [str(y) for y in years],
-                    'Revenue': revenue_vals,
-                    'Cost of Goods': cogs_vals,
-                    'Total Expenses': expenses_vals,
-                    'Other Income': other_income_vals
-                })
-                
-                # Process normalizations similarly
-                amort_vals = []
-                interest_vals = []
-                mgmt_salary_vals = []
-                discr_exp_vals = []
-                mgr_salary_vals = []
-                
-                for item, mapped in normalization_mapping.items():
-                    if mapped and is_transposed:
-                        row_idx = available_items.index(mapped)
-                        values = df_uploaded.iloc[row_idx, 1:len(years)+1].tolist()
-                    else:
-                        values = [0] * len(years)
-                    
-                    if "Amortization" in item:
-                        amort_vals = values
-                    elif "Interest" in item:
-                        interest_vals = values
-                    elif "Owner" in item or "Management Salary" in item:
-                        mgmt_salary_vals = values
-                    elif "Discretionary" in item:
-                        discr_exp_vals = values
-                    elif "Replacement" in item or "Manager Salary" in item:
-                        mgr_salary_vals = values
-                
-                # Create weighting (most recent years get more weight)
-                total_years = len(years)
-                if total_years <= 3:
-                    weightings = [100 // total_years] * total_years
+                # Build both tables from the long frame in one pass
+                try:
+                    financial_data, normalization_data = build_statement_tables(
+                        long_data, {**financial_mapping, **normalization_mapping}
+                    )
+                except ValueError as e:
+                    st.error(str(e))
                 else:
-                    # Last year gets most weight
-                    weightings = [0] * (total_years - 3) + [20, 30, 50]
-                
-                st.session_state.normalization_data = pd.DataFrame({
-                    'Year': [str(y) for y in years],
-                    'Amortization': amort_vals,
-                    'Interest (Capital Lease)': interest_vals,
-                    'Management Salary': mgmt_salary_vals,
-                    'Discretionary Expense': discr_exp_vals,
-                    'Manager Salary': mgr_salary_vals,
-                    'Year Weighting (%)': weightings
-                })
-                
-                st.success("✅ Data processed successfully! Scroll down to review and edit.")
-                st.rerun()
+                    st.session_state.financial_data = financial_data
+                    st.session_state.normalization_data = normalization_data
+                    
+                    st.success("✅ Data processed successfully! Scroll down to review and edit.")
+                    st.rerun()
         
         except Exception as e:
             st.error(f"Error reading file: {e}")
@@ -1151,29 +1196,43 @@ with tab4:
         weighted_avg_revenue = fin_data['Revenue'].iloc[-1]
         weighted_avg_sde = sde_values[-1]
     
-    # Get comparable transactions from PeerComps dataset
+    # Get comparable transactions from PeerComps dataset; sample data stands in until the first load finishes
+    peercomps_loader = get_peercomps_loader()
+    peercomps_pending = peercomps_loader.status == 'loading' and peercomps_loader.store is None
+    if peercomps_loader.status == 'loading':
+        show_peercomps_progress()
     USD_TO_CAD = 1.40
+    fx_rates = get_fx_rates()
+    comparable_method = st.radio(
+        "Comparable selection",
+        ["Nearest neighbours", "NAICS filter"],
+        horizontal=True,
+        help="Nearest neighbours ranks every transaction by NAICS, revenue, SDE margin and age. "
+             "NAICS filter keeps the closest NAICS prefix, 50%-200% of revenue and the last 5 years."
+    )
     transactions = find_comparable_transactions(
         naics_code=naics_full_code,
         revenue=weighted_avg_revenue,
         year_range=5,
         max_results=20,
-        usd_to_cad=USD_TO_CAD
+        usd_to_cad=USD_TO_CAD,
+        sde=weighted_avg_sde,
+        method='nearest' if comparable_method == "Nearest neighbours" else 'filter',
+        fx=fx_rates
     )
     
+    # Range of the rates the comparables were converted at
+    rates_used = [t['usd_to_cad'] for t in transactions if 'usd_to_cad' in t]
+    usd_to_cad_range = [min(rates_used), max(rates_used)] if rates_used else [USD_TO_CAD, USD_TO_CAD]
+    
+    # Industry multiples for the company's NAICS code and revenue band (PeerComps amounts are USD)
+    current_rate = fx_rates.latest if fx_rates is not None else USD_TO_CAD
+    industry_multiples = lookup_industry_multiples(naics_full_code, weighted_avg_revenue / current_rate)
+    
     # Calculate valuation multiples from comparables
-    if transactions:
-        revenue_multiples = [t['rev_mult'] for t in transactions if t['rev_mult'] > 0]
-        sde_multiples = [t['sde_mult'] for t in transactions if t['sde_mult'] > 0 and t['sde_mult'] < 10]
-        ebitda_multiples = [t['ebitda_mult'] for t in transactions if t['ebitda_mult'] > 0 and t['ebitda_mult'] < 15]
-        
-        revenue_multiple = round(sum(revenue_multiples) / len(revenue_multiples), 2) if revenue_multiples else 0.84
-        sde_multiple = round(sum(sde_multiples) / len(sde_multiples), 2) if sde_multiples else 3.7
-        adj_ebitda_multiple = round(sum(ebitda_multiples) / len(ebitda_multiples), 2) if ebitda_multiples else 4.45
-    else:
-        revenue_multiple = 0.84
-        sde_multiple = 3.7
-        adj_ebitda_multiple = 4.45
+    revenue_multiple = comparable_multiple(transactions, 'rev_mult', industry_multiples)
+    sde_multiple = comparable_multiple(transactions, 'sde_mult', industry_multiples)
+    adj_ebitda_multiple = comparable_multiple(transactions, 'ebitda_mult', industry_multiples)
     
     mpsp = int(weighted_avg_revenue * revenue_multiple)
     
@@ -1225,7 +1284,9 @@ with tab4:
             "adj_ebitda_multiple": adj_ebitda_multiple,
             "weighted_avg_revenue": int(weighted_avg_revenue),
             "weighted_avg_sde": int(weighted_avg_sde),
-            "usd_to_cad_rate": USD_TO_CAD
+            "usd_to_cad_rate": USD_TO_CAD,
+            "usd_to_cad_range": usd_to_cad_range,
+            "industry_multiples": industry_multiples
         },
         "financial_data": {
             "years": fin_data['Year'].tolist(),
@@ -1414,7 +1475,11 @@ with tab4:
             st.warning(f"⚠️ Showing {len(transactions)} sample transactions (PeerComps data not available or no matches found)")
         else:
             st.success(f"✅ Found {len(transactions)} real comparable transactions from PeerComps dataset")
-            st.info(f"Amounts converted from USD to CAD at rate of {USD_TO_CAD}")
+            if usd_to_cad_range[0] != usd_to_cad_range[1]:
+                st.info(f"Amounts converted from USD to CAD at each transaction year's rate "
+                        f"({usd_to_cad_range[0]:.4f} - {usd_to_cad_range[1]:.4f})")
+            else:
+                st.info(f"Amounts converted from USD to CAD at rate of {usd_to_cad_range[0]}")
     
     if transactions:
         trans_df = pd.DataFrame(transactions[:10])  # Show first 10
@@ -1422,6 +1487,25 @@ with tab4:
     else:
         st.error("No comparable transactions available")
     
+    if industry_multiples:
+        st.markdown("**Industry Multiples (all PeerComps transactions in the group)**")
+        multiple_names = {"rev_mult": "Revenue", "sde_mult": "SDE", "ebitda_mult": "Adj. EBITDA"}
+        industry_df = pd.DataFrame([
+            {
+                "Multiple": name,
+                "NAICS": industry_multiples[field]['naics_prefix'],
+                "Revenue Band": industry_multiples[field]['revenue_band'],
+                "Count": industry_multiples[field]['count'],
+                "P10": round(industry_multiples[field]['p10'], 2),
+                "P25": round(industry_multiples[field]['p25'], 2),
+                "Median": round(industry_multiples[field]['median'], 2),
+                "P75": round(industry_multiples[field]['p75'], 2),
+                "P90": round(industry_multiples[field]['p90'], 2)
+            }
+            for field, name in multiple_names.items() if field in industry_multiples
+        ])
+        st.dataframe(industry_df, use_container_width=True)
+    
     st.divider()
     
     # JSON preview
@@ -1436,10 +1520,14 @@ with tab4:
         data=json_string,
         file_name=f"{company_name.replace(' ', '_').replace('.', '')}_valuation_data.json",
         mime="application/json",
-        use_container_width=True
+        use_container_width=True,
+        disabled=peercomps_pending
     )
     
-    st.success("✅ Ready to download! Use this JSON file with: `python generate_report.py your_file.json`")
+    if peercomps_pending:
+        st.info("⏳ Download is available once the PeerComps dataset has loaded.")
+    else:
+        st.success("✅ Ready to download! Use this JSON file with: `python generate_report.py your_file.json`")
 
 # Sidebar with instructions
 with st.sidebar:
@@ -1471,11 +1559,20 @@ with st.sidebar:
     
     ### PeerComps Integration
     
-    The app automatically searches the PeerComps dataset for comparable transactions based on:
-    - NAICS code match (6, 5, 4, or 3 digit)
-    - Similar revenue (50%-200% of your business)
-    - Recent years (last 5 years)
-    - USD amounts converted to CAD at 1.40
+    The app automatically searches the PeerComps dataset for comparable transactions. By default it
+    ranks every transaction by similarity to your business and keeps the 20 closest, combining:
+    - NAICS code distance (how far up the NAICS tree the codes meet)
+    - Revenue (on a log scale)
+    - SDE margin
+    - Transaction age
+    
+    The NAICS filter option instead keeps the closest NAICS prefix (6, 5, 4, 3 or 2 digit),
+    similar revenue (50%-200% of your business) and recent years (last 5 years).
+    
+    USD amounts are converted to CAD at each transaction year's rate when a rate table is saved
+    as `usd_cad_rates.csv` next to the app (CSV with `year`, `rate` and optionally `month`
+    columns; monthly rates are averaged per year). Without the table, or for transactions
+    without a year, the rate is 1.40.
     
     ### Generate Report
     ```bash
@@ -1483,30 +1580,71 @@ with st.sidebar:
     pdflatex valuation_report.tex
     ```
     
+    ### Query Comparables Without the App
+    ```bash
+    python peercomps.py query 311999 500000 --sde 100000
+    python peercomps.py ingest delta.xlsx
+    ```
+    
     ### Dependencies
     ```bash
     pip install streamlit pandas rapidfuzz openpyxl
+    pip install scipy  # optional, KD-tree comparables search
     ```
     """)
     
     st.divider()
     
     # Show dataset status
-    df = load_peercomps()
-    if df is not None:
-        st.success(f"✅ PeerComps dataset loaded ({len(df):,} transactions)")
+    store = load_peercomps()
+    if store is not None:
+        st.success(f"✅ PeerComps dataset loaded ({len(store):,} transactions)")
+        if store.duplicates_removed:
+            st.caption(f"{store.duplicates_removed:,} duplicate transactions removed")
+        
+        memory = store.memory_report()
+        before, now = memory['total']
+        st.caption(f"Memory: {now / 2**20:,.1f} MB (float64 layout: {before / 2**20:,.1f} MB)")
+        
+        comparables_cache = get_comparables_cache()
+        st.caption(
+            f"Comparables query cache: {comparables_cache.hits:,} hits, "
+            f"{comparables_cache.misses:,} misses ({len(comparables_cache.entries)} entries)"
+        )
+        
+        fx_rates = get_fx_rates()
+        if fx_rates is not None:
+            st.caption(
+                f"USD→CAD rates: {fx_rates.years[0]}-{fx_rates.years[-1]} "
+                f"({fx_rates.rates.min():.4f} - {fx_rates.rates.max():.4f})"
+            )
+        elif os.path.exists(FX_RATES_PATH):
+            st.warning(f"⚠️ Could not read {FX_RATES_PATH}; converting at 1.40")
         
         with st.expander("📊 Dataset Information"):
             st.markdown("**Available Columns:**")
-            cols_list = ", ".join(df.columns.tolist())
+            cols_list = ", ".join(store.source_columns)
             st.text(cols_list)
             
-            # Show column detection results
+            # Bytes held by the compact store against the float64/int64 layout
+            st.markdown("**Memory Usage:**")
+            st.dataframe(pd.DataFrame([
+                {
+                    "Part": MEMORY_REPORT_PARTS[part],
+                    "Float64 layout (MB)": round(before / 2**20, 2),
+                    "Compact (MB)": round(now / 2**20, 2),
+                    "Saved": f"{1 - now / before:.0%}" if before else "-"
+                }
+                for part, (before, now) in memory.items()
+            ]), hide_index=True, use_container_width=True)
+            
+            # Show column detection results (resolved once when the dataset loaded)
             st.markdown("**Detected Key Columns:**")
-            naics_col = find_column(df, ['NAICS Code', 'NAICS', 'naics_code'])
-            year_col = find_column(df, ['Year', 'year', 'Transaction Year'])
-            revenue_col = find_column(df, ['Revenue', 'revenue', 'Sales'])
-            price_col = find_column(df, ['Sale Price', 'Price', 'price'])
+            schema = store.schema
+            naics_col = schema['naics']
+            year_col = schema['year']
+            revenue_col = schema['revenue']
+            price_col = schema['price']
             
             col_status = []
             col_status.append(f"✅ NAICS: {naics_col}" if naics_col else "❌ NAICS: Not found")
@@ -1519,7 +1657,7 @@ with st.sidebar:
             
             # Show sample data
             st.markdown("**Sample Data (first 5 rows):**")
-            st.dataframe(df.head(5), use_container_width=True)
+            st.dataframe(store.rows(slice(0, 5)), use_container_width=True)
             
             # Test button
             if st.button("🧪 Test Dataset Search"):
@@ -1536,6 +1674,28 @@ with st.sidebar:
                     st.dataframe(pd.DataFrame(test_transactions[:5]))
                 else:
                     st.error("No transactions found in test search")
+        
+        with st.expander("📥 Ingest PeerComps Delta"):
+            st.markdown("Append a monthly delta workbook of new transactions. Transactions already in the dataset are skipped.")
+            delta_file = st.file_uploader("Delta workbook", type=['xlsx', 'csv'], key="peercomps_delta")
+            if delta_file is not None and st.button("Ingest Delta"):
+                with tempfile.NamedTemporaryFile(suffix=os.path.splitext(delta_file.name)[1], delete=False) as tmp:
+                    tmp.write(delta_file.getvalue())
+                try:
+                    with st.spinner("Ingesting delta..."):
+                        result = ingest_peercomps_delta(tmp.name)
+                    if result['already_ingested']:
+                        st.info("This delta workbook has already been ingested.")
+                    else:
+                        st.success(f"Added {result['added']:,} transactions ({result['duplicates']:,} duplicates skipped)")
+                except Exception as e:
+                    st.error(f"Error ingesting delta: {e}")
+                finally:
+                    os.remove(tmp.name)
+    elif get_peercomps_loader().status == 'loading':
+        st.info("⏳ Loading PeerComps dataset...")
+    elif get_peercomps_loader().status == 'failed':
+        st.error(f"Error loading PeerComps dataset: {get_peercomps_loader().error}")
     else:
         st.warning("⚠️ PeerComps dataset not found. Using sample data.")
         st.info("Place 'PeerComps_dataset.xlsx' in the same directory as this app to use real data.")
\ No newline at end of file